@@ -0,0 +1,132 @@
+import abc
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Tuple
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from allocation.adapters import orm
+
+
+DEFAULT_TTL = 24 * 60 * 60  # seconds
+
+
+class AbstractIdempotencyStore(abc.ABC):
+    # Results of commands, by idempotency key, kept for ttl seconds. Only
+    # successful results are stored, so a command that failed can be retried.
+    @abc.abstractmethod
+    def get(self, key: str) -> Tuple[bool, Any]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, key: str, result: Any):
+        raise NotImplementedError
+
+    # Units of work with a session stage the result of the command they
+    # handle in its transaction, and tell the store once it has committed.
+    # Stores kept elsewhere only store it then.
+
+    def stage(self, session: Session, key: str, result: Any):
+        pass
+
+    def committed(self, key: str, result: Any):
+        self.put(key, result)
+
+
+class MemoryIdempotencyStore(AbstractIdempotencyStore):
+    def __init__(self, maxsize: int = 10_000, ttl: float = DEFAULT_TTL, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        # every entry lives for the same ttl, so the oldest expire first
+        self._results = OrderedDict()  # type: OrderedDict[str, Tuple[float, Any]]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return False, None
+            expires, result = entry
+            if expires <= self.clock():
+                del self._results[key]
+                return False, None
+            return True, result
+
+    def put(self, key, result):
+        now = self.clock()
+        with self._lock:
+            self._results[key] = (now + self.ttl, result)
+            self._results.move_to_end(key)
+            while self._results:
+                oldest_expires, _ = next(iter(self._results.values()))
+                if len(self._results) <= self.maxsize and oldest_expires > now:
+                    break
+                self._results.popitem(last=False)
+
+
+class SqlAlchemyIdempotencyStore(AbstractIdempotencyStore):
+    # Survives restarts and is shared between processes. Recent keys are
+    # also kept in memory, and expired rows are deleted every purge_every puts.
+    # Results staged by a unit of work are written in the command's own
+    # transaction, so a command and its result are committed together.
+    def __init__(self, session_factory, ttl: float = DEFAULT_TTL, cache_size: int = 1000, purge_every: int = 1000):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.recent = MemoryIdempotencyStore(cache_size, ttl)
+        self.purge_every = purge_every
+        self._puts = 0
+
+    def get(self, key):
+        found, result = self.recent.get(key)
+        if found:
+            return found, result
+        with self.session_factory() as session:
+            row = session.execute(
+                select(orm.idempotency_keys.c.result)
+                .where(orm.idempotency_keys.c.key == key)
+                .where(orm.idempotency_keys.c.created_at > self._cutoff())
+            ).first()
+        if row is None:
+            return False, None
+        result = json.loads(row.result)
+        self.recent.put(key, result)
+        return True, result
+
+    def put(self, key, result):
+        with self.session_factory() as session:
+            try:
+                self.stage(session, key, result)
+                session.commit()
+            except IntegrityError:
+                # another process got there first, and its result stands
+                return
+        self.committed(key, result)
+
+    def stage(self, session, key, result):
+        # An expired key can be reused. If the key is still live, another
+        # process handled the same command first: the insert fails, and with
+        # it the transaction, so the command isn't applied twice.
+        session.execute(
+            delete(orm.idempotency_keys)
+            .where(orm.idempotency_keys.c.key == key)
+            .where(orm.idempotency_keys.c.created_at <= self._cutoff())
+        )
+        session.execute(
+            orm.idempotency_keys.insert(),
+            dict(key=key, result=json.dumps(result), created_at=datetime.now()),
+        )
+
+    def committed(self, key, result):
+        self.recent.put(key, result)
+        self._puts += 1
+        if self._puts % self.purge_every == 0:
+            with self.session_factory() as session:
+                session.execute(delete(orm.idempotency_keys).where(orm.idempotency_keys.c.created_at <= self._cutoff()))
+                session.commit()
+
+    def _cutoff(self) -> datetime:
+        return datetime.now() - timedelta(seconds=self.ttl)
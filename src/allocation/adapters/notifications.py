@@ -1,6 +1,7 @@
 import abc
 import smtplib
-from allocation import config
+import threading
+from allocation import config, tracing
 
 
 class AbstractNotifications(abc.ABC):
@@ -17,11 +18,14 @@ class EmailNotifications(AbstractNotifications):
     def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
         self.server = smtplib.SMTP(smtp_host, port=port)
         self.server.noop()
+        # one connection, shared by handlers that may run in worker threads
+        self.lock = threading.Lock()
 
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
-        self.server.sendmail(
-            from_addr="allocations@example.com",
-            to_addrs=[destination],
-            msg=msg,
-        )
\ No newline at end of file
+        with self.lock, tracing.span("email.send"):
+            self.server.sendmail(
+                from_addr="allocations@example.com",
+                to_addrs=[destination],
+                msg=msg,
+            )
\ No newline at end of file
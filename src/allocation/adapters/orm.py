@@ -1,4 +1,5 @@
-from sqlalchemy import Table, Column, Integer, String, Date, ForeignKey, event
+import sys
+from sqlalchemy import Table, Column, Index, Integer, String, Text, Date, DateTime, ForeignKey, event
 from sqlalchemy.orm import registry, relationship
 from allocation.domain import model
 
@@ -13,6 +14,8 @@ order_lines = Table(
     Column('sku', String(255)),
     Column('qty', Integer, nullable=False),
     Column('orderid', String(255)),
+    # views.allocations looks lines up by order, and an order's lines by sku
+    Index('ix_order_lines_orderid_sku', 'orderid', 'sku'),
 )
 
 
@@ -20,8 +23,8 @@ batches = Table(
     'batches',
     mapper_registry.metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('reference', String(255)),
-    Column('sku', ForeignKey('products.sku')),
+    Column('reference', String(255), index=True, unique=True),
+    Column('sku', ForeignKey('products.sku'), index=True),
     Column('_purchased_quantity', Integer, nullable=False),
     Column('eta', Date, nullable=True),
 )
@@ -31,8 +34,10 @@ allocations = Table(
     'allocations',
     mapper_registry.metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('orderline_id', ForeignKey('order_lines.id')),
+    Column('orderline_id', ForeignKey('order_lines.id'), index=True),
     Column('batch_id', ForeignKey('batches.id')),
+    # a batch's allocations are loaded by batch_id; a line is allocated to it once
+    Index('ix_allocations_batch_id_orderline_id', 'batch_id', 'orderline_id', unique=True),
 )
 
 
@@ -44,6 +49,56 @@ products = Table(
 )
 
 
+archived_batches = Table(
+    'archived_batches',
+    mapper_registry.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('reference', String(255)),
+    Column('sku', String(255)),
+    Column('_purchased_quantity', Integer, nullable=False),
+    Column('eta', Date, nullable=True),
+)
+
+
+archived_allocations = Table(
+    'archived_allocations',
+    mapper_registry.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('batchref', String(255)),
+    Column('orderid', String(255), index=True),
+    Column('sku', String(255)),
+    Column('qty', Integer, nullable=False),
+)
+
+
+outbox = Table(
+    'outbox',
+    mapper_registry.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('channel', String(255), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+)
+
+
+idempotency_keys = Table(
+    'idempotency_keys',
+    mapper_registry.metadata,
+    Column('key', String(255), primary_key=True),
+    Column('result', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False, index=True),
+)
+
+
+def migrate(engine):
+    # create_all only creates missing tables, so indexes added to tables that
+    # already exist are created here too
+    mapper_registry.metadata.create_all(engine)
+    for table in mapper_registry.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 def start_mappers():
     lines_mapper = mapper_registry.map_imperatively(model.OrderLine, order_lines)
     batches_mapper = mapper_registry.map_imperatively(
@@ -56,10 +111,28 @@ def start_mappers():
         },
     )
     mapper_registry.map_imperatively(
-        model.Product, products, properties={"batches": relationship(batches_mapper)}
+        model.Product,
+        products,
+        properties={"batches": relationship(batches_mapper)},
+        # the domain bumps the version; updates only apply if it is unchanged in the db
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
-    product.events = []
\ No newline at end of file
+    product.events = []
+    product._eta_keys = None
+
+
+@event.listens_for(model.OrderLine, "load")
+def receive_line_load(line, _):
+    # every line of a product repeats its sku, so share one string between them
+    line.__dict__["sku"] = sys.intern(line.sku)
+
+
+@event.listens_for(model.Batch, "load")
+@event.listens_for(model.Batch, "refresh")
+def receive_batch_load(batch, *_):
+    batch._allocated_quantity = None
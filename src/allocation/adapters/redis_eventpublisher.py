@@ -1,8 +1,10 @@
 import json
 import logging
 import redis
+import redis.asyncio
 from dataclasses import asdict
-from allocation import config
+from datetime import date
+from allocation import config, tracing
 from allocation.domain import events
 
 
@@ -10,11 +12,29 @@ logger = logging.getLogger(__name__)
 
 
 r = redis.Redis(**config.get_redis_host_and_port())
+async_r = redis.asyncio.Redis(**config.get_redis_host_and_port())
 
 
 def publish(channel, event: events.Event):
     logging.debug("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    with tracing.span("redis.publish", channel=channel):
+        r.publish(channel, serialize(event))
+
+
+async def publish_async(channel, event: events.Event):
+    logging.debug("publishing: channel=%s, event=%s", channel, event)
+    await async_r.publish(channel, serialize(event))
+
+
+def serialize(event: events.Event) -> str:
+    return json.dumps(dict(asdict(event), correlation_id=event.correlation_id), default=_encode)
+
+
+def _encode(value):
+    # dates, like a batch's eta, go out as ISO strings
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
 
 def update_readmodel(orderid, sku, batchref):
@@ -1,6 +1,13 @@
 import abc
+import threading
+from collections import Counter, OrderedDict
+from typing import Iterable, List, Optional, Set
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+from allocation import tracing
 from allocation.adapters import orm
 from allocation.domain import model
+from allocation.metrics import Metrics
 
 
 class AbstractProductRepository(abc.ABC):
@@ -8,21 +15,32 @@ class AbstractProductRepository(abc.ABC):
         self.seen = set()
 
     def add(self, product: model.Product):
-        self._add(product)
+        with tracing.span("repository.add", sku=product.sku):
+            self._add(product)
         self.seen.add(product)
 
     def get(self, sku) -> model.Product:
-        product = self._get(sku)
+        with tracing.span("repository.get", sku=sku):
+            product = self._get(sku)
         if product:
             self.seen.add(product)
         return product
 
     def get_by_batchref(self, batchref) -> model.Product:
-        product = self._get_by_batchref(batchref)
+        with tracing.span("repository.get_by_batchref", batchref=batchref):
+            product = self._get_by_batchref(batchref)
         if product:
             self.seen.add(product)
         return product
 
+    def archive(self, batches: List[model.Batch]):
+        with tracing.span("repository.archive", batches=len(batches)):
+            self._archive(batches)
+
+    def sku_for_batchref(self, batchref) -> Optional[str]:
+        product = self._get_by_batchref(batchref)
+        return product.sku if product else None
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -35,17 +53,271 @@ class AbstractProductRepository(abc.ABC):
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def _archive(self, batches: List[model.Batch]):
+        raise NotImplementedError
+
+
+# batchref -> sku, shared between sessions. A batch never moves to another
+# sku, so entries never go stale; the oldest are dropped past maxsize.
+class BatchrefSkus:
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._skus = OrderedDict()  # type: OrderedDict[str, str]
+
+    def get(self, batchref: str) -> Optional[str]:
+        sku = self._skus.get(batchref)
+        if sku is not None:
+            self._skus.move_to_end(batchref)
+        return sku
+
+    def add(self, batchref: str, sku: str):
+        self._skus[batchref] = sku
+        self._skus.move_to_end(batchref)
+        if len(self._skus) > self.maxsize:
+            self._skus.popitem(last=False)
+
+
+# How a product's batches, and their allocations, are loaded with it:
+#  - lazy: when first used, one query for the batches and one per batch
+#  - selectin: one query for the batches and one for all their allocations
+#  - joined: all in the product's own query, one row per allocation
+LOADING_STRATEGIES = ("lazy", "selectin", "joined")
+
+
+def loading_options(loading: str) -> list:
+    # built per query: the mapped attributes only exist after start_mappers
+    if loading == "lazy":
+        return []
+    if loading == "selectin":
+        return [selectinload(model.Product.batches).selectinload(model.Batch._allocations)]  # type: ignore
+    if loading == "joined":
+        return [joinedload(model.Product.batches).joinedload(model.Batch._allocations)]  # type: ignore
+    raise ValueError(f"Unknown loading strategy {loading!r}, expected one of {LOADING_STRATEGIES}")
+
+
+# Products, with their batches and allocations, kept between sessions. A
+# product is taken out of the cache while a session uses it and only put back
+# once that session has committed, so the cache never holds changes that were
+# rolled back. Whoever takes a product checks its version against the
+# database before using it, to catch changes made by other processes.
+class ProductCache:
+    def __init__(self, maxsize: int = 1000, metrics: Optional[Metrics] = None):
+        self.maxsize = maxsize
+        self.metrics = metrics
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+        self.lookups = Counter()  # type: Counter[str]
+
+    def __len__(self):
+        return len(self._products)
+
+    @property
+    def hit_rate(self) -> float:
+        total = sum(self.lookups.values())
+        return self.lookups["hit"] / total if total else 0.0
+
+    def take(self, sku: str) -> Optional[model.Product]:
+        with self._lock:
+            return self._products.pop(sku, None)
+
+    def put(self, products: Iterable[model.Product]):
+        with self._lock:
+            for product in products:
+                self._products[product.sku] = product
+                self._products.move_to_end(product.sku)
+            while len(self._products) > self.maxsize:
+                self._products.popitem(last=False)
+
+    def record(self, result: str):
+        # result is one of hit, miss or stale
+        with self._lock:
+            self.lookups[result] += 1
+        if self.metrics is not None:
+            self.metrics.increment("product_cache_lookups_total", result=result)
+
 
 class SqlAlchemyRepository(AbstractProductRepository):
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        batchref_skus: Optional[BatchrefSkus] = None,
+        product_cache: Optional[ProductCache] = None,
+        loading: str = "selectin",
+    ):
         super().__init__()
         self.session = session
+        self.batchref_skus = batchref_skus if batchref_skus is not None else BatchrefSkus()
+        self.product_cache = product_cache
+        self._looked_up = set()  # type: Set[str]
+        # commands use every allocation of the product they load, so by
+        # default they are all loaded up front, in a fixed number of queries
+        if loading not in LOADING_STRATEGIES:
+            raise ValueError(f"Unknown loading strategy {loading!r}, expected one of {LOADING_STRATEGIES}")
+        self.loading = loading
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        # commands handled together get the same product; it is already loaded
+        for product in self.seen:
+            if product.sku == sku:
+                return product
+        # the cache can't gain a product while this session is open, so each
+        # sku is only looked up in it once
+        if self.product_cache is not None and sku not in self._looked_up:
+            self._looked_up.add(sku)
+            product = self._get_cached(self.product_cache, sku)
+            if product is not None:
+                return product
+        return self.session.query(model.Product).filter_by(sku=sku).options(*loading_options(self.loading)).first()
+
+    def _get_cached(self, cache: ProductCache, sku):
+        product = cache.take(sku)
+        if product is None:
+            cache.record("miss")
+            return None
+        version = self.session.execute(
+            select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        ).scalar()
+        if version != product.version_number:
+            cache.record("stale")
+            return None
+        cache.record("hit")
+        # attaches its batches and allocations too, without loading them again
+        self.session.add(product)
+        return product
 
     def _get_by_batchref(self, batchref):
-        return self.session.query(model.Product).join(model.Batch).filter(orm.batches.c.reference == batchref).first()
\ No newline at end of file
+        sku = self.sku_for_batchref(batchref)
+        if sku is None:
+            return None
+        return self._get(sku)
+
+    def sku_for_batchref(self, batchref):
+        # without loading the product
+        sku = self.batchref_skus.get(batchref)
+        if sku is None:
+            row = self.session.query(orm.batches.c.sku).filter(orm.batches.c.reference == batchref).first()
+            if row is None:
+                return None
+            sku = row.sku
+            self.batchref_skus.add(batchref, sku)
+        return sku
+
+    def _archive(self, batches):
+        if not batches:
+            return
+        self.session.execute(orm.archived_batches.insert(), archived_batch_rows(batches))
+        allocation_rows = archived_allocation_rows(batches)
+        if allocation_rows:
+            self.session.execute(orm.archived_allocations.insert(), allocation_rows)
+        for batch in batches:
+            for line in detach_allocations(batch):
+                self.session.delete(line)
+            self.session.delete(batch)
+
+
+class AbstractAsyncProductRepository(abc.ABC):
+    def __init__(self):
+        self.seen = set()
+
+    def add(self, product: model.Product):
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku) -> model.Product:
+        product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_by_batchref(self, batchref) -> model.Product:
+        product = await self._get_by_batchref(batchref)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def archive(self, batches: List[model.Batch]):
+        await self._archive(batches)
+
+    @abc.abstractmethod
+    def _add(self, product: model.Product):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get(self, sku) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_by_batchref(self, batchref) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _archive(self, batches: List[model.Batch]):
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyRepository(AbstractAsyncProductRepository):
+    def __init__(self, session, batchref_skus: Optional[BatchrefSkus] = None):
+        super().__init__()
+        self.session = session
+        self.batchref_skus = batchref_skus if batchref_skus is not None else BatchrefSkus()
+
+    def _add(self, product):
+        self.session.add(product)
+
+    async def _get(self, sku):
+        # there is no lazy loading under asyncio, so load the whole aggregate
+        result = await self.session.execute(
+            select(model.Product)
+            .filter_by(sku=sku)
+            .options(*loading_options("selectin"))
+        )
+        return result.scalars().first()
+
+    async def _get_by_batchref(self, batchref):
+        sku = self.batchref_skus.get(batchref)
+        if sku is None:
+            result = await self.session.execute(
+                select(orm.batches.c.sku).where(orm.batches.c.reference == batchref)
+            )
+            sku = result.scalars().first()
+            if sku is None:
+                return None
+            self.batchref_skus.add(batchref, sku)
+        return await self._get(sku)
+
+    async def _archive(self, batches):
+        if not batches:
+            return
+        await self.session.execute(orm.archived_batches.insert(), archived_batch_rows(batches))
+        allocation_rows = archived_allocation_rows(batches)
+        if allocation_rows:
+            await self.session.execute(orm.archived_allocations.insert(), allocation_rows)
+        for batch in batches:
+            for line in detach_allocations(batch):
+                await self.session.delete(line)
+            await self.session.delete(batch)
+
+
+def archived_batch_rows(batches: List[model.Batch]) -> List[dict]:
+    return [
+        dict(reference=b.reference, sku=b.sku, _purchased_quantity=b._purchased_quantity, eta=b.eta)
+        for b in batches
+    ]
+
+
+def archived_allocation_rows(batches: List[model.Batch]) -> List[dict]:
+    return [
+        dict(batchref=b.reference, orderid=line.orderid, sku=line.sku, qty=line.qty)
+        for b in batches
+        for line in b._allocations
+    ]
+
+
+def detach_allocations(batch: model.Batch) -> List[model.OrderLine]:
+    lines = list(batch._allocations)
+    batch._allocations.clear()
+    return lines
@@ -1,7 +1,14 @@
+import asyncio
+import functools
 import inspect
-from typing import Callable
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, Optional, Type
 from allocation.adapters import notifications, orm, redis_eventpublisher
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.adapters.idempotency import AbstractIdempotencyStore
+from allocation.adapters.notifications import EmailNotifications
+from allocation.adapters.repository import ProductCache
+from allocation.metrics import Metrics
+from allocation.service_layer import async_handlers, handlers, messagebus, unit_of_work
 
 
 def bootstrap(
@@ -9,16 +16,47 @@ def bootstrap(
         uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
         notifications: notifications.AbstractNotifications = notifications.EmailNotifications(),
         publish: Callable = redis_eventpublisher.publish,
+        wave_executor: Optional[Executor] = None,
+        side_effect_executor: Optional[Executor] = None,
+        side_effect_timeout: float = 10.0,
+        use_outbox: bool = False,
+        max_retries: int = 3,
+        metrics: Optional[Metrics] = None,
+        idempotency_store: Optional[AbstractIdempotencyStore] = None,
+        coalesce_commands: bool = False,
+        priorities: Optional[Dict[Type, int]] = None,
+        product_cache: Optional[ProductCache] = None,
+        warm_product_cache: int = 0,
 ) -> messagebus.MessageBus:
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {'uow': uow, 'notifications': notifications, 'publish': publish}
+    if use_outbox:
+        # the outbox relay publishes these events instead of the handlers
+        uow.use_outbox(handlers.PUBLISHED_CHANNELS)
+
+    if metrics is not None:
+        uow.metrics = metrics
+
+    if idempotency_store is not None:
+        # results are stored in the same transaction as the command
+        uow.use_idempotency_store(idempotency_store)
+
+    if product_cache is not None:
+        uow.product_cache = product_cache
+        if warm_product_cache:
+            # the hottest products, loaded before the first command needs them
+            uow.warm_product_cache(warm_product_cache)
+
+    dependencies = {
+        'uow': uow, 'notifications': notifications, 'publish': publish, 'wave_executor': wave_executor,
+    }
     injected_event_handlers = {
         event_type: [
             inject_dependencies(handler, dependencies)
             for handler in event_handlers
+            if not (use_outbox and 'publish' in inspect.signature(handler).parameters)
         ]
         for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
     }
@@ -31,6 +69,13 @@ def bootstrap(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        side_effect_executor=side_effect_executor,
+        side_effect_timeout=side_effect_timeout,
+        max_retries=max_retries,
+        metrics=metrics,
+        idempotency_store=idempotency_store,
+        coalesce_commands=coalesce_commands,
+        priorities=priorities,
     )
 
 
@@ -41,4 +86,64 @@ def inject_dependencies(handler, dependencies):
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
\ No newline at end of file
+    injected = functools.update_wrapper(lambda message: handler(message, **deps), handler)  # type: Any
+    injected.side_effect_only = getattr(handler, 'side_effect_only', False)
+    return injected
+
+
+def bootstrap_async(
+        start_orm: bool = True,
+        uow_factory: Optional[Callable[[], unit_of_work.AbstractAsyncUnitOfWork]] = None,
+        notifications: Optional[notifications.AbstractNotifications] = None,
+        publish: Callable = redis_eventpublisher.publish_async,
+) -> messagebus.AsyncMessageBus:
+
+    if start_orm:
+        orm.start_mappers()
+
+    if uow_factory is None:
+        session_factory = unit_of_work.default_async_session_factory()
+        batchref_skus = unit_of_work.repository.BatchrefSkus()
+        uow_factory = functools.partial(unit_of_work.AsyncSqlAlchemyUnitOfWork, session_factory, batchref_skus)
+    if notifications is None:
+        notifications = EmailNotifications()
+
+    dependencies = {'notifications': notifications, 'publish': publish}
+    injected_event_handlers = {
+        event_type: [
+            inject_async_dependencies(handler, dependencies)
+            for handler in event_handlers
+        ]
+        for event_type, event_handlers in async_handlers.EVENT_HANDLERS.items()
+    }
+    injected_command_handlers = {
+        command_type: inject_async_dependencies(handler, dependencies)
+        for command_type, handler in async_handlers.COMMAND_HANDLERS.items()
+    }
+
+    return messagebus.AsyncMessageBus(
+        uow_factory=uow_factory,
+        event_handlers=injected_event_handlers,
+        command_handlers=injected_command_handlers,
+    )
+
+
+def inject_async_dependencies(handler, dependencies):
+    # the unit of work is per message, so it is passed in by the bus;
+    # handlers that are not coroutines run in a thread, off the event loop
+    params = inspect.signature(handler).parameters
+    deps = {
+        name: dependency
+        for name, dependency in dependencies.items()
+        if name in params
+    }
+    takes_uow = 'uow' in params
+    if inspect.iscoroutinefunction(handler):
+        async def injected(message, uow):
+            if takes_uow:
+                return await handler(message, uow=uow, **deps)
+            return await handler(message, **deps)
+    else:
+        async def injected(message, uow):
+            return await asyncio.to_thread(handler, message, **deps)
+    return injected
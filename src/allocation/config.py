@@ -25,4 +25,33 @@ def get_email_host_and_port():
     host = os.environ.get("EMAIL_HOST", "localhost")
     port = 11025 if host == "localhost" else 1025
     http_port = 18025 if host == "localhost" else 8025
-    return dict(host=host, port=port, http_port=http_port)
\ No newline at end of file
+    return dict(host=host, port=port, http_port=http_port)
+
+
+def get_consumer_workers():
+    return int(os.environ.get("CONSUMER_WORKERS", 1))
+
+
+def get_db_isolation_level():
+    # products are protected by their version number, so READ COMMITTED is safe
+    return os.environ.get("DB_ISOLATION_LEVEL", "REPEATABLE READ")
+
+
+def get_trace_file():
+    # spans are only recorded when this is set
+    return os.environ.get("TRACE_FILE")
+
+
+def get_combine_window():
+    # how long, in seconds, concurrent allocations wait to be handled together
+    return float(os.environ.get("COMBINE_WINDOW_MS", 2)) / 1000
+
+
+def get_product_cache_size():
+    # products kept loaded between units of work; 0 turns the cache off
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 1000))
+
+
+def get_product_cache_warm():
+    # how many of the most allocated products to load at startup
+    return int(os.environ.get("PRODUCT_CACHE_WARM", 0))
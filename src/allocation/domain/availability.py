@@ -0,0 +1,56 @@
+from __future__ import annotations
+from datetime import date
+from typing import TYPE_CHECKING, Iterable, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
+
+if TYPE_CHECKING:
+    from allocation.domain.model import Batch
+
+
+enabled = np is not None
+
+
+class BatchAvailability:
+    # Purchased and allocated quantities and ETAs of a product's batches as
+    # NumPy arrays, in the order the batches were added, so that allocation
+    # queries over thousands of batches are a few vectorized operations.
+    # Product keeps it in step with the Batch objects.
+
+    def __init__(self, batches: Iterable[Batch]):
+        self.batches = list(batches)
+        self.positions = {batch: i for i, batch in enumerate(self.batches)}
+        self.purchased = np.array([b._purchased_quantity for b in self.batches], dtype=np.int64)
+        self.allocated = np.array([b.allocated_quantity for b in self.batches], dtype=np.int64)
+        self.eta = np.array([eta_ordinal(b.eta) for b in self.batches], dtype=np.int64)
+
+    def add(self, batch: Batch):
+        self.positions[batch] = len(self.batches)
+        self.batches.append(batch)
+        self.purchased = np.append(self.purchased, batch._purchased_quantity)
+        self.allocated = np.append(self.allocated, batch.allocated_quantity)
+        self.eta = np.append(self.eta, eta_ordinal(batch.eta))
+
+    def update(self, batch: Batch):
+        i = self.positions[batch]
+        self.purchased[i] = batch._purchased_quantity
+        self.allocated[i] = batch.allocated_quantity
+
+    def first_fit(self, qty: int) -> Optional[Batch]:
+        available = self.purchased - self.allocated
+        fits = np.flatnonzero((available >= qty) & (available > 0))
+        if not len(fits):
+            return None
+        # argmin picks the first of equal ETAs, i.e. the earliest added
+        return self.batches[fits[np.argmin(self.eta[fits])]]
+
+    def total_available(self) -> int:
+        return int(np.maximum(self.purchased - self.allocated, 0).sum())
+
+
+def eta_ordinal(eta: Optional[date]) -> int:
+    # warehouse stock (no ETA) sorts ahead of every shipment
+    return 0 if eta is None else eta.toordinal()
@@ -1,20 +1,49 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional, Tuple
 
 
 class Command:
-    pass
+    # not dataclass fields, so they stay out of equality, repr and asdict
+    __slots__ = ("_correlation_id", "_idempotency_key")
 
+    @property
+    def correlation_id(self) -> Optional[str]:
+        return getattr(self, "_correlation_id", None)
 
-@dataclass
+    @correlation_id.setter
+    def correlation_id(self, correlation_id: Optional[str]):
+        self._correlation_id = correlation_id
+
+    # commands sent again with the same key get the first one's result
+    @property
+    def idempotency_key(self) -> Optional[str]:
+        return getattr(self, "_idempotency_key", None)
+
+    @idempotency_key.setter
+    def idempotency_key(self, idempotency_key: Optional[str]):
+        self._idempotency_key = idempotency_key
+
+
+@dataclass(slots=True)
 class Allocate(Command):
     orderid: str
     sku: str
     qty: int
 
 
-@dataclass
+@dataclass(slots=True)
+class AllocateMany(Command):
+    sku: str
+    lines: List[Tuple[str, int]]  # (orderid, qty)
+
+
+@dataclass(slots=True)
+class AllocateWave(Command):
+    lines: List[Tuple[str, str, int]]  # (orderid, sku, qty)
+
+
+@dataclass(slots=True)
 class CreateBatch(Command):
     ref: str
     sku: str
@@ -22,14 +51,20 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
 
 
-@dataclass
+@dataclass(slots=True)
 class Deallocate(Command):
     orderid: str
     sku: str
-    qty: int
\ No newline at end of file
+    qty: int
+
+
+@dataclass(slots=True)
+class ArchiveBatches(Command):
+    sku: str
+    as_of: date
\ No newline at end of file
@@ -1,16 +1,26 @@
 from dataclasses import dataclass
+from typing import Optional
 
 
 class Event:
-    pass
+    # not a dataclass field, so it stays out of equality, repr and asdict
+    __slots__ = ("_correlation_id",)
 
+    @property
+    def correlation_id(self) -> Optional[str]:
+        return getattr(self, "_correlation_id", None)
 
-@dataclass
+    @correlation_id.setter
+    def correlation_id(self, correlation_id: Optional[str]):
+        self._correlation_id = correlation_id
+
+
+@dataclass(slots=True)
 class OutOfStock(Event):
     sku: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Allocated(Event):
     orderid: str
     sku: str
@@ -18,7 +28,7 @@ class Allocated(Event):
     batchref: str
 
 
-@dataclass
+@dataclass(slots=True)
 class BatchCreated(Event):
     ref: str
     sku: str
@@ -26,7 +36,7 @@ class BatchCreated(Event):
     eta: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Deallocated(Event):
     orderid: str
     sku: str
@@ -34,6 +44,6 @@ class Deallocated(Event):
     batchref: str
 
 
-@dataclass
+@dataclass(slots=True)
 class NotAllocated(Event):
     orderid: str
\ No newline at end of file
@@ -1,8 +1,10 @@
 from __future__ import annotations
+from bisect import bisect_left, insort
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
-from allocation.domain import events, commands
+from itertools import islice
+from typing import Dict, Iterator, Optional, List, Set, Tuple
+from allocation.domain import availability, events, wave
 
 
 @dataclass(unsafe_hash=True)
@@ -13,12 +15,16 @@ class OrderLine:
 
 
 class Batch:
+    # when set, every read of allocated_quantity is checked against the lines
+    verify_allocated_quantity = False
+
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
         self.reference = ref
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -39,19 +45,34 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            allocated = self.allocated_quantity
             self._allocations.add(line)
+            self._allocated_quantity = allocated + line.qty
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
+            allocated = self.allocated_quantity
             self._allocations.remove(line)
+            self._allocated_quantity = allocated - line.qty
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        elif self.verify_allocated_quantity:
+            expected = sum(line.qty for line in self._allocations)
+            if self._allocated_quantity != expected:
+                raise AssertionError(
+                    f"{self!r} allocated quantity is {self._allocated_quantity}, lines add up to {expected}"
+                )
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -60,61 +81,227 @@ class Batch:
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
+    def is_closed(self, as_of: date) -> bool:
+        return self.available_quantity <= 0 and (self.eta is None or self.eta <= as_of)
+
 
 class Product:
+    # products with at least this many batches answer allocation queries from
+    # NumPy arrays, when NumPy is installed
+    vectorize_from = 1000
+    # but only once this many open batches have been tried one by one, as
+    # the first open batch usually fits and a vectorized scan touches them all
+    walk_before_vectorizing = 16
+
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
         self.events = [] # type: List[events.Event]
+        self._eta_keys = None  # type: Optional[Dict[Batch, EtaKey]]
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
+        [batchref] = self.allocate_many([line])
+        return batchref
+
+    def allocate_many(self, lines: List[OrderLine]) -> List[Optional[str]]:
+        batchrefs = []  # type: List[Optional[str]]
+        allocated = False
+        for line in lines:
+            if self.is_allocated(line):
+                batchrefs.append(self._allocated_to[line].reference)
+                continue
+            batch = self._allocate(line)
+            batchrefs.append(batch.reference if batch else None)
+            allocated = allocated or batch is not None
+        if allocated:
             self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
-        except StopIteration:
-            self.events.append(events.OutOfStock(sku=line.sku))
-            return None
+        return batchrefs
 
-    def deallocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if line in b._allocations)
-            batch.deallocate(line)
+    def wave_problem(self, lines: List[OrderLine]) -> wave.Problem:
+        return wave.Problem(
+            batches=[(batch.reference, batch.available_quantity) for batch in self._open_batches()],
+            qtys=[line.qty for line in self._pending(lines)],
+        )
+
+    def allocate_wave(self, lines: List[OrderLine], plan: Optional[wave.Plan] = None) -> List[Optional[str]]:
+        if plan is None:
+            plan = wave.solve(self.wave_problem(lines))
+        planned = dict(zip(self._pending(lines), plan))
+        batchrefs = []  # type: List[Optional[str]]
+        allocated = False
+        for line in lines:
+            if self.is_allocated(line):
+                batchrefs.append(self._allocated_to[line].reference)
+                continue
+            batchref = planned.get(line)
+            batch = None if batchref is None else self._by_reference.get(batchref)
+            if batch is not None and batch.can_allocate(line):
+                self._allocate_to(line, batch)
+            elif batchref is not None:
+                # the plan is out of date: allocate as usual
+                batch = self._allocate(line)
+            else:
+                self.events.append(events.OutOfStock(sku=line.sku))
+            if batch is not None:
+                allocated = True
+            batchrefs.append(batch.reference if batch is not None else None)
+        if allocated:
             self.version_number += 1
-            self.events.append(
-                events.Deallocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
-        except StopIteration:
+        return batchrefs
+
+    def deallocate(self, line: OrderLine) -> str:
+        if not self.is_allocated(line):
             self.events.append(events.NotAllocated(orderid=line.orderid))
             return None
+        batch = self._allocated_to.pop(line)
+        batch.deallocate(line)
+        self._reindex(batch)
+        self.version_number += 1
+        self.events.append(
+            events.Deallocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+        return batch.reference
+
+    @property
+    def available_quantity(self) -> int:
+        self._index_batches()
+        if self._availability is not None:
+            return self._availability.total_available()
+        return sum(batch.available_quantity for batch in self._open_batches())
+
+    def is_allocated(self, line: OrderLine) -> bool:
+        self._index_batches()
+        return line in self._allocated_to
 
     def add_batch(self, batch: Batch):
+        eta_keys = self._index_batches()
         self.batches.append(batch)
+        self._add_to_index(batch, eta_keys, position=len(self.batches) - 1)
         self.version_number += 1
         self.events.append(events.BatchCreated(batch.reference, self.sku, batch._purchased_quantity, batch.eta))
 
     def get_batch(self, reference: str) -> Batch:
-        return next(b for b in self.batches if b.reference == reference)
+        self._index_batches()
+        return self._by_reference[reference]
 
     def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+        batch = self.get_batch(ref)
         batch._purchased_quantity = qty
+        displaced = []
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
-            self.events.append(commands.Allocate(orderid=line.orderid, sku=line.sku, qty=line.qty))
\ No newline at end of file
+            self._allocated_to.pop(line, None)
+            displaced.append(line)
+        self._reindex(batch)
+        for line in displaced:
+            self._allocate(line)
+        self.version_number += 1
+
+    def archive_closed_batches(self, as_of: date) -> List[Batch]:
+        closed = [batch for batch in self.batches if batch.is_closed(as_of)]
+        if closed:
+            for batch in closed:
+                self.batches.remove(batch)
+            self._eta_keys = None
+            self.version_number += 1
+        return closed
+
+    def _allocate(self, line: OrderLine) -> Optional[Batch]:
+        batch = self._first_batch_for(line)
+        if batch is None:
+            self.events.append(events.OutOfStock(sku=line.sku))
+            return None
+        self._allocate_to(line, batch)
+        return batch
+
+    def _allocate_to(self, line: OrderLine, batch: Batch):
+        batch.allocate(line)
+        self._allocated_to[line] = batch
+        self._reindex(batch)
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+
+    def _pending(self, lines: List[OrderLine]) -> List[OrderLine]:
+        pending = dict.fromkeys(
+            line for line in lines if line.sku == self.sku and not self.is_allocated(line)
+        )
+        return list(pending)
+
+    # Batches are kept in allocation order (warehouse stock first, then by
+    # ETA, ties broken by insertion order) so that allocating does not have
+    # to sort. Batches with nothing left to allocate are kept out of the open
+    # list entirely. Batches are also indexed by reference, and allocated
+    # lines by the batch holding them, and large products also keep a
+    # BatchAvailability. The indexes are built lazily, since the ORM loads
+    # products without calling __init__.
+
+    def _index_batches(self) -> Dict[Batch, EtaKey]:
+        if self._eta_keys is not None and len(self._eta_keys) == len(self.batches):
+            return self._eta_keys
+        self._by_reference = {batch.reference: batch for batch in self.batches}
+        self._eta_keys = {batch: _eta_key(batch, position) for position, batch in enumerate(self.batches)}
+        self._in_eta_order = sorted(
+            (key, batch) for batch, key in self._eta_keys.items()
+        )  # type: List[Tuple[EtaKey, Batch]]
+        self._open = [
+            (key, batch) for key, batch in self._in_eta_order if batch.available_quantity > 0
+        ]  # type: List[Tuple[EtaKey, Batch]]
+        self._allocated_to = {
+            line: batch for _, batch in reversed(self._in_eta_order) for line in batch._allocations
+        }  # type: Dict[OrderLine, Batch]
+        self._availability = None  # type: Optional[availability.BatchAvailability]
+        if availability.enabled and len(self.batches) >= self.vectorize_from:
+            self._availability = availability.BatchAvailability(self.batches)
+        return self._eta_keys
+
+    def _add_to_index(self, batch: Batch, eta_keys: Dict[Batch, EtaKey], position: int):
+        self._by_reference[batch.reference] = batch
+        key = eta_keys[batch] = _eta_key(batch, position)
+        insort(self._in_eta_order, (key, batch))
+        if self._availability is not None:
+            self._availability.add(batch)
+        self._reindex(batch)
+
+    def _reindex(self, batch: Batch):
+        key = self._index_batches()[batch]
+        i = bisect_left(self._open, (key,))
+        listed = i < len(self._open) and self._open[i][0] == key
+        if batch.available_quantity > 0 and not listed:
+            self._open.insert(i, (key, batch))
+        elif batch.available_quantity <= 0 and listed:
+            del self._open[i]
+        if self._availability is not None:
+            self._availability.update(batch)
+
+    def _first_batch_for(self, line: OrderLine) -> Optional[Batch]:
+        if self._availability is None:
+            return next((b for b in self._open_batches() if b.can_allocate(line)), None)
+        if line.sku != self.sku:
+            return None
+        for batch in islice(self._open_batches(), self.walk_before_vectorizing):
+            if batch.can_allocate(line):
+                return batch
+        return self._availability.first_fit(line.qty)
+
+    def _open_batches(self) -> Iterator[Batch]:
+        self._index_batches()
+        return (batch for _, batch in self._open)
+
+
+EtaKey = Tuple[bool, date, int]
+
+
+def _eta_key(batch: Batch, position: int) -> EtaKey:
+    return (batch.eta is not None, batch.eta or date.min, position)
\ No newline at end of file
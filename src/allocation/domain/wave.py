@@ -0,0 +1,87 @@
+from concurrent.futures import Executor
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+
+class Problem(NamedTuple):
+    batches: List[Tuple[str, int]]  # (reference, available quantity), in allocation order
+    qtys: List[int]
+
+
+Plan = List[Optional[str]]
+
+
+# Allocating a wave of lines one at a time in arrival order lets an early
+# large line take the stock several later lines could have shared. solve()
+# looks at the whole wave instead:
+#
+#  1. admit lines smallest first while total stock lasts, which is the
+#     largest number of lines the stock could possibly cover;
+#  2. pack the admitted lines, largest first, each into the earliest batch
+#     with room for it, which keeps late shipments for when they are needed;
+#  3. offer whatever is left, smallest first, to any batch that can take it.
+#
+# Packing can still strand a line that arrival order would have fitted, so
+# the arrival order plan is worked out too, and whichever leaves fewer lines
+# out of stock wins; the packed one on a tie.
+#
+# Problems and plans are plain data so that waves for different skus can be
+# solved in other processes.
+
+
+def solve(problem: Problem) -> Plan:
+    packed = _packed(problem)
+    in_arrival_order = _in_arrival_order(problem)
+    if in_arrival_order.count(None) < packed.count(None):
+        return in_arrival_order
+    return packed
+
+
+def _packed(problem: Problem) -> Plan:
+    qtys = problem.qtys
+    first_fit = _first_fit(problem)
+    plan = [None] * len(qtys)  # type: Plan
+    by_size = sorted(range(len(qtys)), key=lambda i: (qtys[i], i))
+    stock = sum(qty for _, qty in problem.batches if qty > 0)
+    admitted = []
+    for i in by_size:
+        if qtys[i] > stock:
+            break
+        stock -= qtys[i]
+        admitted.append(i)
+    for i in sorted(admitted, key=lambda i: (-qtys[i], i)):
+        plan[i] = first_fit(qtys[i])
+    for i in by_size:
+        if plan[i] is None:
+            plan[i] = first_fit(qtys[i])
+    return plan
+
+
+def _in_arrival_order(problem: Problem) -> Plan:
+    # what allocating the lines one at a time would do
+    first_fit = _first_fit(problem)
+    return [first_fit(qty) for qty in problem.qtys]
+
+
+def _first_fit(problem: Problem) -> Callable[[int], Optional[str]]:
+    # takes qty from the earliest batch with room for it, on its own copy of
+    # the available quantities
+    refs = [ref for ref, _ in problem.batches]
+    available = [qty for _, qty in problem.batches]
+    open_batches = [i for i, qty in enumerate(available) if qty > 0]
+
+    def first_fit(qty: int) -> Optional[str]:
+        for n, i in enumerate(open_batches):
+            if available[i] >= qty:
+                available[i] -= qty
+                if not available[i]:
+                    del open_batches[n]
+                return refs[i]
+        return None
+
+    return first_fit
+
+
+def solve_all(problems: List[Problem], executor: Optional[Executor] = None) -> List[Plan]:
+    if executor is None or len(problems) < 2:
+        return [solve(problem) for problem in problems]
+    return list(executor.map(solve, problems))
@@ -1,18 +1,70 @@
-from flask import Flask, jsonify, request
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, g, jsonify, request
 from datetime import datetime
 
-from allocation import bootstrap, views
+from allocation import bootstrap, config, tracing, views
+from allocation.adapters.idempotency import SqlAlchemyIdempotencyStore
+from allocation.adapters.repository import ProductCache
+from allocation.metrics import Metrics
 from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer.combiner import Combiner
 from allocation.service_layer.handlers import InvalidSku, OutOfStock
 
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+metrics = Metrics()
+tracing.configure_from_file(config.get_trace_file())
+cache_size = config.get_product_cache_size()
+bus = bootstrap.bootstrap(
+    side_effect_executor=ThreadPoolExecutor(max_workers=4), use_outbox=True, metrics=metrics,
+    idempotency_store=SqlAlchemyIdempotencyStore(unit_of_work.DEFAULT_SESSION_FACTORY),
+    coalesce_commands=True,
+    priorities=handlers.PRIORITIES,
+    product_cache=ProductCache(cache_size, metrics=metrics) if cache_size else None,
+    warm_product_cache=config.get_product_cache_warm(),
+)
+# concurrent allocations are handled in batches, one commit per sku; any
+# other use of the bus holds allocations.lock, as it isn't thread-safe
+allocations = Combiner(bus, window=config.get_combine_window(), metrics=metrics)
+
+
+def with_idempotency_key(cmd, suffix=""):
+    # clients retrying a POST send the same Idempotency-Key header
+    key = request.headers.get("Idempotency-Key")
+    if key:
+        cmd.idempotency_key = key + suffix
+    return cmd
+
+
+@app.before_request
+def start_correlation():
+    correlation_id = request.headers.get("X-Correlation-ID") or tracing.new_correlation_id()
+    g.correlation_token = tracing.set_correlation_id(correlation_id)
+
+
+@app.after_request
+def add_correlation_header(response):
+    response.headers["X-Correlation-ID"] = tracing.get_correlation_id()
+    return response
+
+
+@app.teardown_request
+def end_correlation(_):
+    token = g.pop("correlation_token", None)
+    if token is not None:
+        tracing.reset_correlation_id(token)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    # reads get a unit of work of their own rather than sharing the bus's
+    result = views.allocations(orderid, unit_of_work.SqlAlchemyUnitOfWork())
     if not result:
         return "not found", 404
     return jsonify(result), 200
@@ -26,12 +78,26 @@ def allocate_endpoint():
             request.json["sku"],
             request.json["qty"]
         )
-        bus.handle(cmd)
+        allocations.submit(with_idempotency_key(cmd))
     except (InvalidSku) as e:
         return {"message": str(e)}, 400
     return "OK", 202
 
 
+@app.route("/bulk_allocate", methods=["POST"])
+def bulk_allocate_endpoint():
+    cmds = [
+        with_idempotency_key(commands.Allocate(line["orderid"], line["sku"], line["qty"]), f"/{i}")
+        for i, line in enumerate(request.json["lines"])
+    ]
+    with allocations.lock:
+        results = bus.handle_many(cmds, return_exceptions=True)
+    return jsonify([
+        {"message": str(result)} if isinstance(result, Exception) else {"batchref": result}
+        for result in results
+    ]), 202
+
+
 @app.route("/add_batch", methods=["POST"])
 def add_batch():
     eta = request.json["eta"]
@@ -44,7 +110,8 @@ def add_batch():
             request.json["qty"],
             eta
         )
-        results = bus.handle(cmd)
+        with allocations.lock:
+            results = bus.handle(with_idempotency_key(cmd))
         batchref = results.pop(0)
     except InvalidSku as e:
         return {"message": str(e)}, 400
@@ -59,7 +126,8 @@ def deallocate():
             request.json["sku"],
             request.json["qty"]
         )
-        results = bus.handle(cmd)
+        with allocations.lock:
+            results = bus.handle(with_idempotency_key(cmd))
         batchref = results.pop(0)
     except InvalidSku as e:
         return {"message": str(e)}, 400
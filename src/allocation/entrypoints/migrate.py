@@ -0,0 +1,20 @@
+import logging
+from sqlalchemy import create_engine
+from allocation import config
+from allocation.adapters import orm
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    # Safe to run against a live database, and more than once. Creating a
+    # unique index fails if the table already holds duplicates, which have
+    # to be cleaned up by hand first.
+    engine = create_engine(config.get_postgres_uri())
+    orm.migrate(engine)
+    logger.info("Schema up to date")
+
+
+if __name__ == "__main__":
+    main()
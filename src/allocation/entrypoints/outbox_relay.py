@@ -0,0 +1,76 @@
+import logging
+import time
+from datetime import datetime
+from typing import List, Tuple
+import redis
+from sqlalchemy import delete, select
+from sqlalchemy.exc import DBAPIError
+from allocation import config, tracing
+from allocation.adapters import orm
+from allocation.service_layer import unit_of_work
+
+
+logger = logging.getLogger(__name__)
+
+
+BATCH_SIZE = 500
+POLL_INTERVAL = 0.1
+MAX_BACKOFF = 30.0
+
+
+def main():
+    logger.info("Outbox relay starting")
+    tracing.configure_from_file(config.get_trace_file())
+    r = redis.Redis(**config.get_redis_host_and_port())
+    session_factory = unit_of_work.DEFAULT_SESSION_FACTORY
+    failures = 0
+    while True:
+        wait, failures = relay_round(session_factory, r, failures)
+        if wait:
+            time.sleep(wait)
+
+
+def relay_round(session_factory, client: redis.Redis, failures: int = 0) -> Tuple[float, int]:
+    # One batch, returning how long to wait before the next and how many
+    # rounds in a row have failed. While Redis or the database is down the
+    # events stay in the outbox, and the relay backs off until it is back.
+    try:
+        with session_factory() as session:
+            relayed = relay_batch(session, client)
+    except (redis.RedisError, DBAPIError):
+        failures += 1
+        wait = min(POLL_INTERVAL * 2 ** failures, MAX_BACKOFF)
+        logger.exception("relaying failed %d times in a row, retrying in %.1fs", failures, wait)
+        return wait, failures
+    if relayed:
+        lag = (datetime.now() - min(relayed)).total_seconds()
+        logger.info("relayed %d events, oldest %.3fs old", len(relayed), lag)
+    return (POLL_INTERVAL if len(relayed) < BATCH_SIZE else 0.0), 0
+
+
+def relay_batch(session, client: redis.Redis, batch_size: int = BATCH_SIZE) -> List[datetime]:
+    # Publishes the oldest events in the outbox with one pipelined round trip,
+    # then deletes them. If the publish fails nothing is deleted, so every
+    # event is published at least once. Rows locked by another relay are
+    # skipped, so several relays can run side by side.
+    rows = session.execute(
+        select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload, orm.outbox.c.created_at)
+        .order_by(orm.outbox.c.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not rows:
+        session.rollback()
+        return []
+    pipe = client.pipeline(transaction=False)
+    for row in rows:
+        pipe.publish(row.channel, row.payload)
+    with tracing.span("outbox.publish", events=len(rows)):
+        pipe.execute()
+    session.execute(delete(orm.outbox).where(orm.outbox.c.id.in_([row.id for row in rows])))
+    session.commit()
+    return [row.created_at for row in rows]
+
+
+if __name__ == "__main__":
+    main()
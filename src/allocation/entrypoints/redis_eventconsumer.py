@@ -1,8 +1,19 @@
 import json
 import logging
+import multiprocessing
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 import redis
-from allocation import bootstrap, config
+from allocation import bootstrap, config, tracing
+from allocation.adapters import repository
+from allocation.adapters.idempotency import SqlAlchemyIdempotencyStore
 from allocation.domain import commands
+from allocation.metrics import Metrics
+from allocation.service_layer import handlers, unit_of_work
 
 
 logger = logging.getLogger(__name__)
@@ -11,9 +22,22 @@ logger = logging.getLogger(__name__)
 r = redis.Redis(**config.get_redis_host_and_port())
 
 
+# commands arriving together are handed to the bus as one batch
+MAX_BATCH = 100
+
+# how often each process logs its metrics, in seconds
+METRICS_INTERVAL = 60
+
+
 def main():
     logger.info("Redis pubusb starting")
-    bus = bootstrap.bootstrap()
+    workers = config.get_consumer_workers()
+    if workers > 1:
+        pool = WorkerPool(workers, unit_of_work.SqlAlchemyUnitOfWork())
+        dispatch = pool.submit
+    else:
+        bus = bootstrap_bus()
+        dispatch = lambda cmds: handle_commands(cmds, bus)
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("allocate")
     pubsub.subscribe("add_batch")
@@ -21,47 +45,147 @@ def main():
     pubsub.subscribe("deallocate")
 
     for m in pubsub.listen():
-        logger.info("handling message %s", m)
-        if m["channel"] == b"allocate":
-            handle_allocate(m, bus)
-        elif m["channel"] == b"add_batch":
-            handle_add_batch(m, bus)
-        elif m["channel"] == b"change_batch_quantity":
-            handle_change_batch_quantity(m, bus)
-        elif m["channel"] == b"deallocate":
-            handle_deallocate(m, bus)
-        else:
-            logger.warning("unknown message %s", m)
-
-
-def handle_allocate(m, bus):
-    logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.Allocate(orderid=data["orderid"], sku=data["sku"], qty=data["qty"])
-    bus.handle(cmd)
+        dispatch(to_commands([m] + drain(pubsub, MAX_BATCH - 1)))
+
+
+def bootstrap_bus():
+    tracing.configure_from_file(config.get_trace_file())
+    metrics = Metrics()
+    threading.Thread(target=log_metrics, args=(metrics, METRICS_INTERVAL), daemon=True).start()
+    cache_size = config.get_product_cache_size()
+    return bootstrap.bootstrap(
+        side_effect_executor=ThreadPoolExecutor(max_workers=4), use_outbox=True, metrics=metrics,
+        idempotency_store=SqlAlchemyIdempotencyStore(unit_of_work.DEFAULT_SESSION_FACTORY),
+        coalesce_commands=True,
+        priorities=handlers.PRIORITIES,
+        product_cache=repository.ProductCache(cache_size, metrics=metrics) if cache_size else None,
+        warm_product_cache=config.get_product_cache_warm(),
+    )
 
 
-def handle_add_batch(m, bus):
-    logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.CreateBatch(
-        ref=data["ref"], sku=data["sku"], qty=data["qty"], eta=data["eta"]
-    )
-    bus.handle(cmd)
+def log_metrics(metrics, interval):
+    while True:
+        time.sleep(interval)
+        logger.info("metrics:\n%s", metrics.summary())
 
 
-def handle_change_batch_quantity(m, bus):
-    logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    bus.handle(cmd)
+def drain(pubsub, limit):
+    messages = []  # type: List[dict]
+    while len(messages) < limit:
+        m = pubsub.get_message()
+        if m is None:
+            break
+        messages.append(m)
+    return messages
 
 
-def handle_deallocate(m, bus):
-    logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.Deallocate(orderid=data["orderid"], sku=data["sku"], qty=data["qty"])
-    bus.handle(cmd)
+def to_commands(messages) -> List[commands.Command]:
+    cmds = []
+    for m in messages:
+        logger.info("handling message %s", m)
+        to_command = COMMANDS.get(m["channel"])
+        if to_command is None:
+            logger.warning("unknown message %s", m)
+            continue
+        data = json.loads(m["data"])
+        cmd = to_command(data)
+        cmd.correlation_id = data.get("correlation_id") or tracing.new_correlation_id()
+        cmd.idempotency_key = data.get("idempotency_key")
+        cmds.append(cmd)
+    return cmds
+
+
+def handle_commands(cmds, bus):
+    results = bus.handle_many(cmds, return_exceptions=True)
+    for cmd, result in zip(cmds, results):
+        if isinstance(result, Exception):
+            logger.error("failed to handle %s: %s", cmd, result)
+
+
+class Partitioner:
+    # Sends every command for a sku to the same one of n workers. Batch
+    # changes only carry the batchref, so its sku is looked up, and batches
+    # being created are remembered so their changes can follow them.
+    def __init__(self, workers: int, uow: unit_of_work.AbstractUnitOfWork):
+        self.workers = workers
+        self.uow = uow
+        self.batchref_skus = repository.BatchrefSkus()
+
+    def partition(self, cmds: List[commands.Command]) -> Dict[int, List[commands.Command]]:
+        partitions = defaultdict(list)  # type: Dict[int, List[commands.Command]]
+        for cmd in cmds:
+            partitions[self.worker_for(cmd)].append(cmd)
+        return partitions
+
+    def worker_for(self, cmd: commands.Command) -> int:
+        return zlib.crc32(self.sku_for(cmd).encode()) % self.workers
+
+    def sku_for(self, cmd: commands.Command) -> str:
+        if isinstance(cmd, commands.ChangeBatchQuantity):
+            sku = self.batchref_skus.get(cmd.ref)
+            if sku is None:
+                with self.uow:
+                    sku = self.uow.products.sku_for_batchref(cmd.ref)
+                if sku is None:
+                    # an unknown batch fails in whichever worker gets it
+                    return cmd.ref
+                self.batchref_skus.add(cmd.ref, sku)
+            return sku
+        if isinstance(cmd, commands.CreateBatch):
+            self.batchref_skus.add(cmd.ref, cmd.sku)
+        return getattr(cmd, "sku", "")
+
+
+class WorkerPool:
+    # One process per worker, each with its own engine and message bus, and
+    # its own queue, so the commands for a sku are handled in order.
+    def __init__(self, workers: int, uow: unit_of_work.AbstractUnitOfWork, queue_size: int = 1000):
+        self.partitioner = Partitioner(workers, uow)
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [context.Process(target=work, args=(queue,), daemon=True) for queue in self.queues]
+        for process in self.processes:
+            process.start()
+
+    def submit(self, cmds: List[commands.Command]):
+        for worker, worker_cmds in self.partitioner.partition(cmds).items():
+            self.queues[worker].put(worker_cmds)
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def work(queue):
+    bus = bootstrap_bus()
+    for cmds in iter(queue.get, None):
+        handle_commands(cmds, bus)
+
+
+def allocate_command(data):
+    return commands.Allocate(orderid=data["orderid"], sku=data["sku"], qty=data["qty"])
+
+
+def add_batch_command(data):
+    return commands.CreateBatch(ref=data["ref"], sku=data["sku"], qty=data["qty"], eta=data["eta"])
+
+
+def change_batch_quantity_command(data):
+    return commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
+
+
+def deallocate_command(data):
+    return commands.Deallocate(orderid=data["orderid"], sku=data["sku"], qty=data["qty"])
+
+
+COMMANDS = {
+    b"allocate": allocate_command,
+    b"add_batch": add_batch_command,
+    b"change_batch_quantity": change_batch_quantity_command,
+    b"deallocate": deallocate_command,
+}
 
 
 if __name__ == "__main__":
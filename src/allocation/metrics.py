@@ -0,0 +1,96 @@
+import bisect
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+
+PREFIX = "allocation_"
+
+SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNTS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        totals, total = [], 0
+        for count in self.counts:
+            total += count
+            totals.append(total)
+        return totals
+
+
+class Metrics:
+    # Histograms and counters, keyed by name and labels, rendered in the
+    # Prometheus text format. Names ending in _seconds are timed with the
+    # SECONDS buckets, anything else observed gets the COUNTS buckets.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}  # type: Dict[str, Dict[Labels, Histogram]]
+        self.counters = {}  # type: Dict[str, Dict[Labels, float]]
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histograms = self.histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(SECONDS if name.endswith("_seconds") else COUNTS)
+            histogram.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counters = self.counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for labels, histogram in sorted(histograms.items()):
+                    bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append(f"{PREFIX}{name}_bucket{render_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{PREFIX}{name}_sum{render_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{render_labels(labels)} {histogram.count}")
+            for name, counters in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for labels, value in sorted(counters.items()):
+                    lines.append(f"{PREFIX}{name}{render_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        # one line per histogram and counter, for logs
+        lines = []
+        with self._lock:
+            for name, histograms in sorted(self.histograms.items()):
+                for labels, histogram in sorted(histograms.items()):
+                    mean = histogram.sum / histogram.count
+                    lines.append(f"{name}{render_labels(labels)} count={histogram.count} mean={mean:.6g}")
+            for name, counters in sorted(self.counters.items()):
+                for labels, value in sorted(counters.items()):
+                    lines.append(f"{name}{render_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+def render_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
@@ -0,0 +1,166 @@
+from collections import defaultdict
+from sqlalchemy import text
+from typing import Awaitable, Callable, List, Dict, Optional, Type
+from allocation.domain import events, model, commands, wave
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.handlers import (
+    InvalidSku, NotAllocated, is_valid_sku, send_out_of_stock_notification,
+)
+
+
+async def allocate(command: commands.Allocate, uow: unit_of_work.AbstractAsyncUnitOfWork) -> str:
+    line = model.OrderLine(command.orderid, command.sku, command.qty)
+    async with uow:
+        product = await uow.products.get(sku=line.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        if not is_valid_sku(line.sku, product.batches):
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        batchref = product.allocate(line)
+        await uow.commit()
+    return batchref
+
+
+async def allocate_many(command: commands.AllocateMany, uow: unit_of_work.AbstractAsyncUnitOfWork) -> List[Optional[str]]:
+    lines = [model.OrderLine(orderid, command.sku, qty) for orderid, qty in command.lines]
+    async with uow:
+        product = await uow.products.get(sku=command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        if not is_valid_sku(command.sku, product.batches):
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        batchrefs = product.allocate_many(lines)
+        await uow.commit()
+    return batchrefs
+
+
+async def allocate_wave(
+    command: commands.AllocateWave, uow: unit_of_work.AbstractAsyncUnitOfWork,
+) -> List[Optional[str]]:
+    lines = [model.OrderLine(orderid, sku, qty) for orderid, sku, qty in command.lines]
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[model.OrderLine]]
+    for line in lines:
+        lines_by_sku[line.sku].append(line)
+    async with uow:
+        batchrefs = {}  # type: Dict[model.OrderLine, Optional[str]]
+        for sku, sku_lines in lines_by_sku.items():
+            product = await uow.products.get(sku=sku)
+            if product is None or not is_valid_sku(sku, product.batches):
+                raise InvalidSku(f"Invalid sku {sku}")
+            batchrefs.update(zip(sku_lines, product.allocate_wave(sku_lines)))
+        await uow.commit()
+    return [batchrefs[line] for line in lines]
+
+
+async def add_batch(command: commands.CreateBatch, uow: unit_of_work.AbstractAsyncUnitOfWork):
+    async with uow:
+        product = await uow.products.get(sku=command.sku)
+        if product is None:
+            product = model.Product(command.sku, batches=[])
+            uow.products.add(product)
+        product.add_batch(model.Batch(command.ref, command.sku, command.qty, command.eta))
+        await uow.commit()
+
+
+async def deallocate(command: commands.Deallocate, uow: unit_of_work.AbstractAsyncUnitOfWork) -> str:
+    line = model.OrderLine(command.orderid, command.sku, command.qty)
+    async with uow:
+        product = await uow.products.get(sku=line.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        if not is_valid_sku(line.sku, product.batches):
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        if not product.is_allocated(line):
+            raise NotAllocated(f"Line {line.orderid} has not been allocated")
+        batchref = product.deallocate(line)
+        await uow.commit()
+    return batchref
+
+
+async def change_batch_quantity(
+    command: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref=command.ref)
+        product.change_batch_quantity(ref=command.ref, qty=command.qty)
+        await uow.commit()
+
+
+async def archive_batches(
+    command: commands.ArchiveBatches, uow: unit_of_work.AbstractAsyncUnitOfWork,
+) -> List[str]:
+    async with uow:
+        product = await uow.products.get(sku=command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        archived = product.archive_closed_batches(as_of=command.as_of)
+        await uow.products.archive(archived)
+        await uow.commit()
+    return [batch.reference for batch in archived]
+
+
+async def publish_allocated_event(event: events.Allocated, publish: Callable[..., Awaitable]):
+    await publish("line_allocated", event)
+
+
+async def publish_batch_created_event(event: events.BatchCreated, publish: Callable[..., Awaitable]):
+    await publish("batch_created", event)
+
+
+async def publish_deallocated_event(event: events.Deallocated, publish: Callable[..., Awaitable]):
+    await publish("line_deallocated", event)
+
+
+async def add_allocation_to_read_model(event: events.Allocated, uow: unit_of_work.AsyncSqlAlchemyUnitOfWork):
+    async with uow:
+        await uow.session.execute(
+            text(
+                """
+                INSERT INTO allocations_view (orderid, sku, batchref)
+                VALUES (:orderid, :sku, :batchref)
+                """
+            ),
+            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref)
+        )
+        await uow.commit()
+
+
+async def remove_allocation_from_read_model(event: events.Deallocated, uow: unit_of_work.AsyncSqlAlchemyUnitOfWork):
+    async with uow:
+        await uow.session.execute(
+            text(
+                """
+                DELETE FROM allocations_view
+                WHERE orderid = :orderid AND sku = :sku
+                """
+            ),
+            dict(orderid=event.orderid, sku=event.sku)
+        )
+        await uow.commit()
+
+
+# send_out_of_stock_notification is the blocking one from handlers; the bus
+# runs handlers that are not coroutines in a worker thread
+EVENT_HANDLERS = {
+    events.Allocated: [
+        publish_allocated_event,
+        add_allocation_to_read_model,
+    ],
+    events.BatchCreated: [publish_batch_created_event],
+    events.Deallocated: [
+        publish_deallocated_event,
+        remove_allocation_from_read_model,
+    ],
+    events.OutOfStock: [send_out_of_stock_notification],
+}   # type: Dict[Type[events.Event], List[Callable]]
+
+
+COMMAND_HANDLERS = {
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.AllocateWave: allocate_wave,
+    commands.CreateBatch: add_batch,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.Deallocate: deallocate,
+    commands.ArchiveBatches: archive_batches,
+}   # type: Dict[Type[commands.Command], Callable]
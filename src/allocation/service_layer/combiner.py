@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+from allocation import tracing
+from allocation.domain import commands
+from allocation.metrics import Metrics
+from allocation.service_layer import messagebus
+
+
+class Combiner:
+    # Commands submitted from many threads at about the same time are handled
+    # together, by one thread, with bus.handle_many: commands for the same sku
+    # share one load of the product and one commit, in the order they were
+    # submitted, and each caller gets back its own result or exception.
+    #
+    # The first caller to find nothing waiting leads the next batch: it waits
+    # up to window seconds for others to join, or until max_batch commands
+    # are waiting, then handles the batch while the others wait for results.
+    def __init__(
+        self,
+        bus: messagebus.MessageBus,
+        window: float = 0.002,
+        max_batch: int = 100,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.bus = bus
+        self.window = window
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self._joining = threading.Condition()
+        self._pending = []  # type: List[Tuple[commands.Command, Future]]
+        # Held while the bus handles a batch. The bus and its unit of work
+        # aren't thread-safe, so anything else using them must hold it too.
+        self.lock = threading.Lock()
+
+    def submit(self, command: commands.Command):
+        # the batch is handled on the leader's thread, so keep ours
+        if command.correlation_id is None:
+            command.correlation_id = tracing.get_correlation_id()
+        future = Future()  # type: Future
+        with self._joining:
+            batch = self._pending
+            batch.append((command, future))
+            leading = len(batch) == 1
+            if len(batch) >= self.max_batch:
+                self._joining.notify_all()
+            if leading:
+                self._joining.wait_for(lambda: len(batch) >= self.max_batch, timeout=self.window)
+                self._pending = []
+        if leading:
+            with self.lock:
+                self._handle(batch)
+        return future.result()
+
+    def _handle(self, batch: List[Tuple[commands.Command, Future]]):
+        if self.metrics is not None:
+            self.metrics.observe("combined_batch_size", len(batch))
+        try:
+            results = self.bus.handle_many([command for command, _ in batch], return_exceptions=True)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -1,7 +1,9 @@
+from collections import defaultdict
+from concurrent.futures import Executor
 from sqlalchemy import text
-from typing import Callable, List, Dict, Type
+from typing import Callable, List, Dict, Optional, Type
 from allocation.adapters import notifications
-from allocation.domain import events, model, commands
+from allocation.domain import events, model, commands, wave
 from allocation.service_layer import unit_of_work
 
 
@@ -25,10 +27,6 @@ def is_in_stock(line, batches):
     return sum(b.available_quantity for b in batches if b.sku == line.sku) >= line.qty
 
 
-def is_allocated(line, batches):
-    return line in {line for batch in batches for line in batch._allocations}
-
-
 def allocate(command: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork) -> str:
     line = model.OrderLine(command.orderid, command.sku, command.qty)
     with uow:
@@ -42,6 +40,45 @@ def allocate(command: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork) -
     return batchref
 
 
+def allocate_many(command: commands.AllocateMany, uow: unit_of_work.AbstractUnitOfWork) -> List[Optional[str]]:
+    lines = [model.OrderLine(orderid, command.sku, qty) for orderid, qty in command.lines]
+    with uow:
+        product = uow.products.get(sku=command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        if not is_valid_sku(command.sku, product.batches):
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        batchrefs = product.allocate_many(lines)
+        uow.commit()
+    return batchrefs
+
+
+def allocate_wave(
+    command: commands.AllocateWave,
+    uow: unit_of_work.AbstractUnitOfWork,
+    wave_executor: Optional[Executor] = None,
+) -> List[Optional[str]]:
+    lines = [model.OrderLine(orderid, sku, qty) for orderid, sku, qty in command.lines]
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[model.OrderLine]]
+    for line in lines:
+        lines_by_sku[line.sku].append(line)
+    with uow:
+        products = []
+        for sku in lines_by_sku:
+            product = uow.products.get(sku=sku)
+            if product is None or not is_valid_sku(sku, product.batches):
+                raise InvalidSku(f"Invalid sku {sku}")
+            products.append(product)
+        problems = [product.wave_problem(lines_by_sku[product.sku]) for product in products]
+        plans = wave.solve_all(problems, wave_executor)
+        batchrefs = {}  # type: Dict[model.OrderLine, Optional[str]]
+        for product, plan in zip(products, plans):
+            sku_lines = lines_by_sku[product.sku]
+            batchrefs.update(zip(sku_lines, product.allocate_wave(sku_lines, plan)))
+        uow.commit()
+    return [batchrefs[line] for line in lines]
+
+
 def add_batch(command: commands.CreateBatch, uow: unit_of_work.AbstractUnitOfWork):
     with uow:
         product = uow.products.get(sku=command.sku)
@@ -60,7 +97,7 @@ def deallocate(command: commands.Deallocate, uow: unit_of_work.AbstractUnitOfWor
             raise InvalidSku(f"Invalid sku {line.sku}")
         if not is_valid_sku(line.sku, product.batches):
             raise InvalidSku(f"Invalid sku {line.sku}")
-        if not is_allocated(line, product.batches):
+        if not product.is_allocated(line):
             raise NotAllocated(f"Line {line.orderid} has not been allocated")
         product.deallocate(line)
         uow.commit()
@@ -73,6 +110,26 @@ def change_batch_quantity(command: commands.ChangeBatchQuantity, uow: unit_of_wo
         uow.commit()
 
 
+def archive_batches(command: commands.ArchiveBatches, uow: unit_of_work.AbstractUnitOfWork) -> List[str]:
+    with uow:
+        product = uow.products.get(sku=command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        archived = product.archive_closed_batches(as_of=command.as_of)
+        uow.products.archive(archived)
+        uow.commit()
+    return [batch.reference for batch in archived]
+
+
+def side_effect_only(handler):
+    # Marks an event handler that only talks to the outside world: it does not
+    # use the unit of work or raise events, so the message bus is free to run
+    # it in the background.
+    handler.side_effect_only = True
+    return handler
+
+
+@side_effect_only
 def send_out_of_stock_notification(event: events.OutOfStock, notifications: notifications.AbstractNotifications):
     notifications.send(
         "stock@made.com",
@@ -80,14 +137,17 @@ def send_out_of_stock_notification(event: events.OutOfStock, notifications: noti
     )
 
 
+@side_effect_only
 def publish_allocated_event(event: events.Allocated, publish: Callable):
     publish("line_allocated", event)
 
 
+@side_effect_only
 def publish_batch_created_event(event: events.BatchCreated, publish: Callable):
     publish("batch_created", event)
 
 
+@side_effect_only
 def publish_deallocated_event(event: events.Deallocated, publish: Callable):
     publish("line_deallocated", event)
 
@@ -120,6 +180,32 @@ def remove_allocation_from_read_model(event: events.Deallocated, uow: unit_of_wo
         uow.commit()
 
 
+# the channels the publish handlers above use, for publishing through the outbox
+PUBLISHED_CHANNELS = {
+    events.Allocated: "line_allocated",
+    events.BatchCreated: "batch_created",
+    events.Deallocated: "line_deallocated",
+}   # type: Dict[Type[events.Event], str]
+
+
+# For buses that schedule messages, lower goes first: changes to stock
+# before allocations, and notifications last. Messages for a sku still
+# keep their order; a batch change counts as a message for its batch's sku.
+PRIORITIES = {
+    commands.CreateBatch: 0,
+    commands.ChangeBatchQuantity: 0,
+    commands.Deallocate: 0,
+    events.BatchCreated: 1,
+    events.Allocated: 1,
+    events.Deallocated: 1,
+    commands.Allocate: 2,
+    commands.AllocateMany: 2,
+    commands.AllocateWave: 2,
+    commands.ArchiveBatches: 3,
+    events.OutOfStock: 3,
+}   # type: Dict[Type, int]
+
+
 EVENT_HANDLERS = {
     events.Allocated: [
         publish_allocated_event,
@@ -136,7 +222,10 @@ EVENT_HANDLERS = {
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.AllocateWave: allocate_wave,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
     commands.Deallocate: deallocate,
+    commands.ArchiveBatches: archive_batches,
 }   # type: Dict[Type[commands.Command], Callable]
\ No newline at end of file
@@ -1,7 +1,20 @@
+import contextvars
+import functools
+import itertools
 import logging
-from typing import Dict, List, Type, Callable, Union
+import random
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple, Type, Callable, Union
+from allocation import tracing
+from allocation.adapters.idempotency import AbstractIdempotencyStore
+from allocation.adapters.repository import BatchrefSkus
 from allocation.domain import commands, events
+from allocation.metrics import Metrics
 from allocation.service_layer import unit_of_work
+from allocation.service_layer.scheduler import Scheduler
 
 
 logger = logging.getLogger(__name__)
@@ -16,16 +29,219 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        side_effect_executor: Optional[futures.Executor] = None,
+        side_effect_timeout: float = 10.0,
+        max_pending_side_effects: int = 1000,
+        max_retries: int = 3,
+        retry_backoff: float = 0.05,
+        metrics: Optional[Metrics] = None,
+        idempotency_store: Optional[AbstractIdempotencyStore] = None,
+        coalesce_commands: bool = False,
+        priorities: Optional[Dict[Type[Message], int]] = None,
+        max_run: int = 50,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.metrics = metrics
+        self.idempotency_store = idempotency_store
+        # see coalesce(); only applies to handle_many
+        self.coalesce_commands = coalesce_commands
+        # Without priorities messages are handled in the order they arrive.
+        # With them, messages are scheduled by sku, lowest priority first, and
+        # handle_many takes at most max_run commands for a sku at a time.
+        # Types without a priority go last.
+        self.priorities = priorities
+        self.batchref_skus = BatchrefSkus()
+        self._levels = max(priorities.values()) + 2 if priorities else 0
+        self.max_run = max_run
+        # commands that lose a race for a product are retried, after a random
+        # delay of up to retry_backoff, doubling with each attempt
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # Event handlers marked side_effect_only run on this executor, when
+        # there is one, and handle() returns without waiting for them.
+        self.side_effect_executor = side_effect_executor
+        self.side_effect_timeout = side_effect_timeout
+        self._side_effect_slots = threading.BoundedSemaphore(max_pending_side_effects)
+        # what each side effect still running is, for the logs
+        self._pending_side_effects = {}  # type: Dict[futures.Future, str]
+        self._pending_lock = threading.Lock()
 
     def handle(self, message: Message):
+        return self._process([message])
+
+    def handle_many(self, messages: List[Message], return_exceptions: bool = False) -> List:
+        # Commands for the same sku are handled together, in one unit of work
+        # and one commit; the events they raise are handled after that commit.
+        # If any command in a group fails, the group is rolled back and its
+        # commands are handled one by one instead, so only the failing ones
+        # fail. A failure raises, unless return_exceptions is set, in which
+        # case the exception takes the place of that message's result.
+        if self.coalesce_commands:
+            return self._handle_coalesced(messages, return_exceptions)
+        return self._handle_many(messages, return_exceptions)
+
+    def _handle_many(self, messages: List[Message], return_exceptions: bool) -> List:
+        results = [None] * len(messages)  # type: List
+        pending = []  # type: List[Tuple[int, Message]]
+        # a command repeated in the batch gets the result of its first copy
+        first_with_key = {}  # type: Dict[str, int]
+        repeats = []  # type: List[Tuple[int, int]]
+        for i, message in enumerate(messages):
+            if isinstance(message, commands.Command):
+                replayed, result = self._replay(message)
+                if replayed:
+                    results[i] = result
+                    continue
+                if self.idempotency_store is not None and message.idempotency_key is not None:
+                    key = self._idempotency_key(message)
+                    if key in first_with_key:
+                        repeats.append((i, first_with_key[key]))
+                        continue
+                    first_with_key[key] = i
+            pending.append((i, message))
+        for group in self._groups(pending):
+            group_results = self._handle_group([message for _, message in group], return_exceptions)
+            for (i, _), result in zip(group, group_results):
+                results[i] = result
+        for i, first in repeats:
+            results[i] = results[first]
+        return results
+
+    def _groups(self, pending: List[Tuple[int, Message]]) -> Iterator[List[Tuple[int, Message]]]:
+        # Messages that aren't commands for a known sku are handled alone and
+        # in their place: everything before them first, everything after them
+        # after. Between them, commands are grouped by sku.
+        segment = []  # type: List[Tuple[str, int, Message]]
+        for i, message in pending:
+            sku = self._sku_of(message) if isinstance(message, commands.Command) else None
+            if sku is None:
+                yield from self._groups_by_sku(segment)
+                segment = []
+                yield [(i, message)]
+            else:
+                segment.append((sku, i, message))
+        yield from self._groups_by_sku(segment)
+
+    def _groups_by_sku(self, segment: List[Tuple[str, int, Message]]) -> Iterator[List[Tuple[int, Message]]]:
+        if self.priorities is None:
+            groups = {}  # type: Dict[str, List[Tuple[int, Message]]]
+            for sku, i, message in segment:
+                groups.setdefault(sku, []).append((i, message))
+            yield from groups.values()
+            return
+        scheduler = Scheduler(
+            lambda item: self._priority_of(item[2]), lambda item: item[0], self._levels, segment,
+        )
+        while scheduler:
+            yield [(i, message) for _, i, message in scheduler.pop_run(self.max_run)]
+
+    def _sku_of(self, message: Message) -> Optional[str]:
+        # batch changes only carry the batchref, so their sku is looked up,
+        # and batches being created are remembered so their changes can
+        # follow them
+        if isinstance(message, commands.ChangeBatchQuantity):
+            sku = self.batchref_skus.get(message.ref)
+            if sku is None:
+                with self.uow:
+                    sku = self.uow.products.sku_for_batchref(message.ref)
+                if sku is not None:
+                    self.batchref_skus.add(message.ref, sku)
+            return sku
+        sku = getattr(message, "sku", None)
+        if isinstance(message, (commands.CreateBatch, events.BatchCreated)):
+            self.batchref_skus.add(message.ref, message.sku)
+        return sku
+
+    def _priority_of(self, message: Message) -> int:
+        if self.priorities is None:
+            return 0
+        return self.priorities.get(type(message), self._levels - 1)
+
+    def _schedule(self, messages: List[Message]) -> Union[Deque[Message], Scheduler[Message]]:
+        if self.priorities is None:
+            return deque(messages)
+        return Scheduler(self._priority_of, self._sku_of, self._levels, messages)
+
+    def _handle_coalesced(self, messages: List[Message], return_exceptions: bool) -> List:
+        coalesced = coalesce(messages)
+        if self.metrics is not None:
+            for message, indexes in coalesced:
+                if len(indexes) > 1:
+                    self.metrics.increment(
+                        "messages_coalesced_total", len(indexes) - 1, command=type(messages[indexes[0]]).__name__,
+                    )
+        results = [None] * len(messages)  # type: List
+        coalesced_results = self._handle_many([message for message, _ in coalesced], return_exceptions=True)
+        for (message, indexes), result in zip(coalesced, coalesced_results):
+            merged_allocations = isinstance(messages[indexes[0]], commands.Allocate) and len(indexes) > 1
+            if merged_allocations and not isinstance(result, Exception):
+                for i, batchref in zip(indexes, result):
+                    results[i] = batchref
+            else:
+                for i in indexes:
+                    results[i] = result
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def _handle_group(self, messages: List[Message], return_exceptions: bool) -> List:
+        # only commands are handled together
+        grouped = [message for message in messages if isinstance(message, commands.Command)]
+        if len(messages) > 1 and len(grouped) == len(messages):
+            results = []
+            # seconds taken by, and events raised by, each command handled
+            handled = []  # type: List[Tuple[float, int]]
+            try:
+                with self.uow:
+                    for command in grouped:
+                        logger.debug("handling command %s", command)
+                        correlation_id = self._correlation_id_for(command)
+                        started = time.perf_counter()
+                        with tracing.correlation(correlation_id), \
+                                tracing.span("command", command=type(command).__name__, grouped=True):
+                            results.append(self.command_handlers[type(command)](command))
+                        raised = self._stamp_new_events(correlation_id)
+                        handled.append((time.perf_counter() - started, raised))
+                        self._remember(command, results[-1])
+                    self.uow.commit()
+                    # collected after the commit, which may write them to the outbox
+                    new_events = list(self.uow.collect_new_events())  # type: List[Message]
+            except Exception:
+                logger.exception("Exception handling commands together, retrying one by one: %s", messages)
+                if self.metrics is not None:
+                    # the command that raised, or all of them if the commit did
+                    failed = grouped[len(handled)] if len(handled) < len(grouped) else None
+                    for command in grouped if failed is None else [failed]:
+                        self.metrics.increment("command_errors_total", command=type(command).__name__, grouped="true")
+            else:
+                if self.metrics is not None:
+                    for command, (seconds, raised) in zip(grouped, handled):
+                        self.metrics.observe("command_seconds", seconds, command=type(command).__name__)
+                        self.metrics.observe("events_per_command", raised, command=type(command).__name__)
+                self._process(new_events)
+                return results
+        return [self._handle_one(message, return_exceptions) for message in messages]
+
+    def _handle_one(self, message: Message, return_exceptions: bool):
+        try:
+            results = self.handle(message)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            return e
+        return results[0] if results else None
+
+    def _process(self, queue: List[Message]):
         results = []
-        self.queue = [message]
+        self.queue = self._schedule(queue)
         while self.queue:
-            message = self.queue.pop(0)
+            if self.metrics is not None:
+                self.metrics.observe("queue_depth", len(self.queue))
+            message = self.queue.popleft()
             if isinstance(message, events.Event):
                 self.handle_event(message)
             elif isinstance(message, commands.Command):
@@ -36,21 +252,285 @@ class MessageBus:
         return results
 
     def handle_event(self, event: events.Event):
+        with tracing.correlation(event.correlation_id):
+            for handler in self.event_handlers[type(event)]:
+                self._handle_event_with(handler, event)
+
+    def _handle_event_with(self, handler: Callable, event: events.Event):
+        if self.side_effect_executor is not None and getattr(handler, "side_effect_only", False):
+            if self._run_in_background(self.side_effect_executor, handler, event):
+                return
+        started = time.perf_counter()
+        try:
+            logger.debug("handling event %s with handler %s", event, handler)
+            with tracing.span("event_handler", event=type(event).__name__, handler=handler.__name__):
+                handler(event)
+            self.queue.extend(self._collect_new_events())
+        except Exception:
+            logger.exception("Exception handling event %s", event)
+            if self.metrics is not None:
+                self.metrics.increment(
+                    "event_handler_errors_total", event=type(event).__name__, handler=handler.__name__,
+                )
+            return
+        if self.metrics is not None:
+            self.metrics.observe(
+                "event_handler_seconds", time.perf_counter() - started,
+                event=type(event).__name__, handler=handler.__name__,
+            )
+
+    def handle_command(self, command: commands.Command):
+        logger.debug("handling command %s", command)
+        with tracing.correlation(self._correlation_id_for(command)):
+            return self._handle_command(command)
+
+    def _handle_command(self, command: commands.Command):
+        replayed, result = self._replay(command)
+        if replayed:
+            return result
+        started = time.perf_counter()
+        try:
+            handler = self.command_handlers[type(command)]
+            if self.idempotency_store is not None and command.idempotency_key is not None:
+                handler = functools.partial(self._handle_remembering, handler)
+            with tracing.span("command", command=type(command).__name__):
+                result = self._retry_on_conflict(handler, command)
+            new_events = self._collect_new_events()
+            self.queue.extend(new_events)
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            if self.metrics is not None:
+                self.metrics.increment("command_errors_total", command=type(command).__name__)
+            raise
+        if self.metrics is not None:
+            self.metrics.observe("command_seconds", time.perf_counter() - started, command=type(command).__name__)
+            self.metrics.observe("events_per_command", len(new_events), command=type(command).__name__)
+        return result
+
+    def _handle_remembering(self, handler: Callable, command: commands.Command):
+        # the handler's commit is deferred to ours, which stores the result
+        # along with the command's changes
+        with self.uow:
+            result = handler(command)
+            self._remember(command, result)
+            self.uow.commit()
+        return result
+
+    def _replay(self, command: commands.Command) -> Tuple[bool, Any]:
+        if self.idempotency_store is None or command.idempotency_key is None:
+            return False, None
+        replayed, result = self.idempotency_store.get(self._idempotency_key(command))
+        if replayed:
+            logger.info("Replaying the result of command %s", command)
+            if self.metrics is not None:
+                self.metrics.increment("command_replays_total", command=type(command).__name__)
+        return replayed, result
+
+    def _remember(self, command: commands.Command, result: Any):
+        # stored by the unit of work when it commits
+        if self.idempotency_store is None or command.idempotency_key is None:
+            return
+        self.uow.remember(self._idempotency_key(command), result)
+
+    @staticmethod
+    def _idempotency_key(command: commands.Command) -> str:
+        # keys are chosen by callers, so they are only unique per command type
+        return f"{type(command).__name__}:{command.idempotency_key}"
+
+    @staticmethod
+    def _correlation_id_for(command: commands.Command) -> str:
+        # commands from an entrypoint carry its id; anything else starts a new one
+        if command.correlation_id is None:
+            command.correlation_id = tracing.get_correlation_id() or tracing.new_correlation_id()
+        return command.correlation_id
+
+    def _collect_new_events(self) -> List[events.Event]:
+        new_events = list(self.uow.collect_new_events())
+        correlation_id = tracing.get_correlation_id()
+        for event in new_events:
+            if event.correlation_id is None:
+                event.correlation_id = correlation_id
+        return new_events
+
+    def _stamp_new_events(self, correlation_id: str) -> int:
+        # for events left on the products until a later commit; returns how
+        # many were new
+        stamped = 0
+        for product in self.uow.products.seen:
+            for event in product.events:
+                if event.correlation_id is None:
+                    event.correlation_id = correlation_id
+                    stamped += 1
+        return stamped
+
+    def _retry_on_conflict(self, handler: Callable, command: commands.Command):
+        for attempt in itertools.count():
+            try:
+                return handler(command)
+            except unit_of_work.ConcurrencyError:
+                if attempt >= self.max_retries:
+                    raise
+                if self.metrics is not None:
+                    self.metrics.increment("command_retries_total", command=type(command).__name__)
+                delay = random.uniform(0, self.retry_backoff * 2 ** attempt)
+                logger.info("Conflict handling command %s, retrying in %.3fs", command, delay)
+                time.sleep(delay)
+
+    def wait_for_side_effects(self, timeout: Optional[float] = None) -> bool:
+        # returns False, and logs the stragglers, if any are still running
+        with self._pending_lock:
+            pending = dict(self._pending_side_effects)
+        _, not_done = futures.wait(pending, timeout=self.side_effect_timeout if timeout is None else timeout)
+        for future in not_done:
+            logger.warning("Side effect still running: %s", pending[future])
+        return not not_done
+
+    def _run_in_background(self, executor: futures.Executor, handler: Callable, event: events.Event) -> bool:
+        # when too much is already queued up, the caller runs it inline instead
+        if not self._side_effect_slots.acquire(blocking=False):
+            logger.warning("Too many side effects pending, handling %s inline", event)
+            return False
+        try:
+            future = executor.submit(
+                contextvars.copy_context().run, self._run_side_effect, handler, event,
+            )
+        except RuntimeError:
+            self._side_effect_slots.release()
+            logger.warning("Side effect executor is shut down, handling %s inline", event)
+            return False
+        with self._pending_lock:
+            self._pending_side_effects[future] = f"{handler} for {event}"
+        future.add_done_callback(functools.partial(self._side_effect_done, event, handler, time.monotonic()))
+        return True
+
+    @staticmethod
+    def _run_side_effect(handler: Callable, event: events.Event):
+        with tracing.span("side_effect", event=type(event).__name__, handler=handler.__name__):
+            handler(event)
+
+    def _side_effect_done(self, event: events.Event, handler: Callable, started: float, future: futures.Future):
+        with self._pending_lock:
+            description = self._pending_side_effects.pop(future, None)
+        self._side_effect_slots.release()
+        elapsed = time.monotonic() - started
+        if elapsed > self.side_effect_timeout:
+            logger.warning("Side effect took %.1fs, over the %.1fs timeout: %s",
+                           elapsed, self.side_effect_timeout, description)
+        exception = future.exception()
+        if exception is not None:
+            logger.error("Exception handling event %s", event, exc_info=exception)
+        if self.metrics is not None:
+            labels = dict(event=type(event).__name__, handler=handler.__name__)
+            self.metrics.observe("side_effect_seconds", elapsed, **labels)
+            if exception is not None:
+                self.metrics.increment("side_effect_errors_total", 1, **labels)
+
+
+def coalesce(messages: List[Message]) -> List[Tuple[Message, List[int]]]:
+    # Collapses messages, returning each message to handle with the positions
+    # of the messages it stands for:
+    #  - in a run of ChangeBatchQuantity, only the last for each ref is kept,
+    #    in the place of that last one. Batches end up with the same
+    #    quantities and allocated stock, but as the earlier changes are
+    #    skipped, the lines moved to other batches can differ.
+    #  - consecutive Allocates for a sku, with no other command for that sku
+    #    or batch change in between, become one AllocateMany, which has the
+    #    same effect as handling them one by one
+    # Commands with an idempotency key are left alone, as their results are
+    # stored one by one.
+    coalesced = []  # type: List[Tuple[Message, List[int]]]
+    changes = {}  # type: Dict[str, List[int]]
+    allocations = {}  # type: Dict[str, Tuple[int, Union[commands.Allocate, commands.AllocateMany]]]
+
+    def end_run_of_changes():
+        for indexes in sorted(changes.values(), key=lambda indexes: indexes[-1]):
+            coalesced.append((messages[indexes[-1]], indexes))
+        changes.clear()
+
+    for i, message in enumerate(messages):
+        keyed = isinstance(message, commands.Command) and message.idempotency_key is not None
+        if isinstance(message, commands.ChangeBatchQuantity) and not keyed:
+            allocations.clear()
+            changes.setdefault(message.ref, []).append(i)
+            continue
+        end_run_of_changes()
+        if isinstance(message, commands.Allocate) and not keyed:
+            if message.sku not in allocations:
+                allocations[message.sku] = (len(coalesced), message)
+                coalesced.append((message, [i]))
+            else:
+                position, merged = allocations[message.sku]
+                merged = _merge_allocation(merged, message)
+                allocations[message.sku] = (position, merged)
+                coalesced[position] = (merged, coalesced[position][1] + [i])
+            continue
+        sku = getattr(message, "sku", None)
+        if sku is None:
+            allocations.clear()
+        else:
+            allocations.pop(sku, None)
+        coalesced.append((message, [i]))
+    end_run_of_changes()
+    return coalesced
+
+
+def _merge_allocation(
+        merged: Union[commands.Allocate, commands.AllocateMany], command: commands.Allocate,
+) -> commands.AllocateMany:
+    if isinstance(merged, commands.Allocate):
+        first = merged
+        merged = commands.AllocateMany(first.sku, [(first.orderid, first.qty)])
+        # the events of every line are traced under the first command's id
+        merged.correlation_id = first.correlation_id
+    merged.lines.append((command.orderid, command.qty))
+    return merged
+
+
+class AsyncMessageBus:
+    # Each call to handle() gets its own unit of work and its own queue, so
+    # many messages can be handled concurrently on one event loop. Handlers
+    # are coroutine functions taking the message and that unit of work.
+    def __init__(
+        self,
+        uow_factory: Callable[[], unit_of_work.AbstractAsyncUnitOfWork],
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+    ):
+        self.uow_factory = uow_factory
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+
+    async def handle(self, message: Message):
+        uow = self.uow_factory()
+        results = []
+        queue = deque([message])
+        while queue:
+            message = queue.popleft()
+            if isinstance(message, events.Event):
+                await self.handle_event(message, uow, queue)
+            elif isinstance(message, commands.Command):
+                results.append(await self.handle_command(message, uow, queue))
+            else:
+                raise Exception(f"{message} was not an Event or Command")
+        return results
+
+    async def handle_event(self, event: events.Event, uow: unit_of_work.AbstractAsyncUnitOfWork, queue: Deque[Message]):
         for handler in self.event_handlers[type(event)]:
             try:
                 logger.debug("handling event %s with handler %s", event, handler)
-                handler(event)
-                self.queue.extend(self.uow.collect_new_events())
+                await handler(event, uow)
+                queue.extend(uow.collect_new_events())
             except Exception:
                 logger.exception("Exception handling event %s", event)
                 continue
 
-    def handle_command(self, command: commands.Command):
+    async def handle_command(self, command: commands.Command, uow: unit_of_work.AbstractAsyncUnitOfWork, queue: Deque[Message]):
         logger.debug("handling command %s", command)
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            result = await handler(command, uow)
+            queue.extend(uow.collect_new_events())
+            return result
         except Exception:
             logger.exception("Exception handling command %s", command)
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,65 @@
+from collections import deque
+from typing import Callable, Deque, Dict, Generic, Hashable, Iterable, List, TypeVar
+
+
+T = TypeVar("T")
+
+
+class Scheduler(Generic[T]):
+    # Items are queued in lanes, by lane_of, and each lane is first in first
+    # out. The next item comes from the lane whose head has the best (lowest)
+    # priority, taking turns between lanes whose heads are equally urgent,
+    # so one busy lane can't hold up the others. With a fixed number of
+    # priorities every operation is O(1) per item.
+    def __init__(
+        self,
+        priority_of: Callable[[T], int],
+        lane_of: Callable[[T], Hashable],
+        levels: int,
+        items: Iterable[T] = (),
+    ):
+        self.priority_of = priority_of
+        self.lane_of = lane_of
+        self._lanes = {}  # type: Dict[Hashable, Deque[T]]
+        # the lanes waiting for a turn, by the priority of their head
+        self._turns = [deque() for _ in range(levels)]  # type: List[Deque[Hashable]]
+        self._len = 0
+        self.extend(items)
+
+    def __len__(self):
+        return self._len
+
+    def append(self, item: T):
+        lane_key = self.lane_of(item)
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            self._lanes[lane_key] = deque([item])
+            self._turns[self.priority_of(item)].append(lane_key)
+        else:
+            lane.append(item)
+        self._len += 1
+
+    def extend(self, items: Iterable[T]):
+        for item in items:
+            self.append(item)
+
+    def popleft(self) -> T:
+        [item] = self.pop_run(1)
+        return item
+
+    def pop_run(self, limit: int) -> List[T]:
+        # up to limit items from the front of the next lane
+        for turns in self._turns:
+            if turns:
+                lane_key = turns.popleft()
+                break
+        else:
+            raise IndexError("pop from an empty Scheduler")
+        lane = self._lanes[lane_key]
+        run = [lane.popleft() for _ in range(min(limit, len(lane)))]
+        self._len -= len(run)
+        if lane:
+            self._turns[self.priority_of(lane[0])].append(lane_key)
+        else:
+            del self._lanes[lane_key]
+        return run
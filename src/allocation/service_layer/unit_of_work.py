@@ -1,23 +1,93 @@
 import abc
-from sqlalchemy import create_engine
+import contextlib
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple, Type
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
 
-from allocation import config
-from allocation.adapters import repository
+from allocation import config, tracing
+from allocation.metrics import Metrics
+from allocation.adapters import orm, redis_eventpublisher, repository
+from allocation.adapters.idempotency import AbstractIdempotencyStore
+from allocation.domain import events, model
+
+
+class ConcurrencyError(Exception):
+    pass
+
+
+# serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = {"40001", "40P01"}
+
+
+@contextlib.contextmanager
+def concurrency_errors():
+    # Another transaction changed the product first: either its version no
+    # longer matched ours, or the database refused to serialize us after it.
+    # Either way, the command can be retried from the start.
+    try:
+        yield
+    except StaleDataError as e:
+        raise ConcurrencyError(str(e)) from e
+    except DBAPIError as e:
+        if getattr(e.orig, "pgcode", None) not in RETRYABLE_PGCODES:
+            raise
+        raise ConcurrencyError(str(e)) from e
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractProductRepository
+    # units of work can be nested; only the outermost one commits or rolls back
+    _depth = 0
+    metrics = None  # type: Optional[Metrics]
+    # events of these types are written to an outbox, on the given channel,
+    # in the same transaction as the change that raised them, by units of
+    # work that have one
+    outbox_channels = {}  # type: Dict[Type[events.Event], str]
+    product_cache = None  # type: Optional[repository.ProductCache]
+    idempotency_store = None  # type: Optional[AbstractIdempotencyStore]
+    # results of commands to store with the next commit, by idempotency key
+    _results = ()  # type: Tuple[Tuple[str, Any], ...]
 
     def __enter__(self):
+        self._depth += 1
         return self
 
     def __exit__(self, *args):
-        self.rollback()
+        self._depth -= 1
+        if not self._depth:
+            self._results = ()
+            self.rollback()
 
     def commit(self):
-        self._commit()
+        if self._depth <= 1:
+            started = time.perf_counter()
+            with tracing.span("uow.commit"):
+                self._commit()
+            results, self._results = self._results, ()
+            if self.idempotency_store is not None:
+                for key, result in results:
+                    self.idempotency_store.committed(key, result)
+            if self.metrics is not None:
+                self.metrics.observe("uow_commit_seconds", time.perf_counter() - started)
+
+    def use_outbox(self, channels: Dict[Type[events.Event], str]):
+        self.outbox_channels = channels
+
+    def use_idempotency_store(self, store: AbstractIdempotencyStore):
+        self.idempotency_store = store
+
+    def remember(self, key: str, result: Any):
+        self._results += ((key, result),)
+
+    def warm_product_cache(self, limit: int):
+        # only units of work with a product cache have anything to warm
+        pass
 
     def collect_new_events(self):
         for product in self.products.seen:
@@ -36,26 +106,156 @@ class AbstractUnitOfWork(abc.ABC):
 DEFAULT_SESSION_FACTORY = sessionmaker(
     bind=create_engine(
         config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
+        isolation_level=config.get_db_isolation_level(),
     )
 )
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        product_cache: Optional[repository.ProductCache] = None,
+        loading: str = "selectin",
+    ):
         self.session_factory = session_factory
+        self.batchref_skus = repository.BatchrefSkus()
+        self.product_cache = product_cache
+        # see repository.LOADING_STRATEGIES
+        self.loading = loading
 
     def __enter__(self):
-        self.session = self.session_factory()   # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        if not self._depth:
+            if self.product_cache is not None:
+                # cached products have to stay loaded after the commit
+                self.session = self.session_factory(expire_on_commit=False)   # type: Session
+            else:
+                self.session = self.session_factory()
+            self.products = repository.SqlAlchemyRepository(
+                self.session, self.batchref_skus, self.product_cache, self.loading,
+            )
         return super().__enter__()
 
     def __exit__(self, *args):
+        # nothing happened since the last commit, so what we hold is in the db
+        committed = not self.session.in_transaction()
         super().__exit__(*args)
-        self.session.close()
+        if not self._depth:
+            self.session.close()
+            if self.product_cache is not None and committed:
+                self.product_cache.put(self.products.seen)
+
+    def warm_product_cache(self, limit: int):
+        # loads the products with the most allocations, batches and all
+        if self.product_cache is None:
+            return
+        with self:
+            skus = self.session.execute(
+                select(orm.batches.c.sku)
+                .select_from(orm.allocations.join(orm.batches))
+                .group_by(orm.batches.c.sku)
+                .order_by(func.count().desc())
+                .limit(limit)
+            ).scalars().all()
+            products = (
+                self.session.query(model.Product)
+                .filter(orm.products.c.sku.in_(skus))
+                .options(*repository.loading_options("selectin"))
+                .all()
+            )
+            # ends the transaction without expiring them
+            self.session.commit()
+        self.product_cache.put(products)
 
     def _commit(self):
-        self.session.commit()
+        with concurrency_errors():
+            if self.outbox_channels:
+                self._write_outbox()
+            if self.idempotency_store is not None:
+                for key, result in self._results:
+                    self.idempotency_store.stage(self.session, key, result)
+            self.session.commit()
+
+    def _write_outbox(self):
+        now = datetime.now()
+        correlation_id = tracing.get_correlation_id()
+        rows = []
+        for product in self.products.seen:
+            for event in product.events:
+                if type(event) not in self.outbox_channels:
+                    continue
+                if event.correlation_id is None:
+                    event.correlation_id = correlation_id
+                rows.append(dict(
+                    channel=self.outbox_channels[type(event)],
+                    payload=redis_eventpublisher.serialize(event),
+                    created_at=now,
+                ))
+        if rows:
+            self.session.execute(orm.outbox.insert(), rows)
 
     def rollback(self):
-        self.session.rollback()
\ No newline at end of file
+        self.session.rollback()
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    products: repository.AbstractAsyncProductRepository
+    _depth = 0
+
+    async def __aenter__(self):
+        self._depth += 1
+        return self
+
+    async def __aexit__(self, *args):
+        self._depth -= 1
+        if not self._depth:
+            await self.rollback()
+
+    async def commit(self):
+        if self._depth <= 1:
+            await self._commit()
+
+    def collect_new_events(self):
+        for product in self.products.seen:
+            while product.events:
+                yield product.events.pop(0)
+
+    @abc.abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+def default_async_session_factory():
+    # built on demand, so that the async driver is only needed when used
+    uri = config.get_postgres_uri().replace("postgresql://", "postgresql+asyncpg://", 1)
+    return async_sessionmaker(
+        bind=create_async_engine(uri, isolation_level=config.get_db_isolation_level()),
+    )
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    def __init__(self, session_factory, batchref_skus: Optional[repository.BatchrefSkus] = None):
+        self.session_factory = session_factory
+        self.batchref_skus = batchref_skus if batchref_skus is not None else repository.BatchrefSkus()
+
+    async def __aenter__(self):
+        if not self._depth:
+            self.session = self.session_factory()   # type: AsyncSession
+            self.products = repository.AsyncSqlAlchemyRepository(self.session, self.batchref_skus)
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        if not self._depth:
+            await self.session.close()
+
+    async def _commit(self):
+        with concurrency_errors():
+            await self.session.commit()
+
+    async def rollback(self):
+        await self.session.rollback()
@@ -0,0 +1,120 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+
+_correlation_id = contextvars.ContextVar("correlation_id", default=None)  # type: contextvars.ContextVar[Optional[str]]
+_current_span = contextvars.ContextVar("current_span", default=None)  # type: contextvars.ContextVar[Optional[Span]]
+_span_ids = itertools.count(1)
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex
+
+
+def get_correlation_id() -> Optional[str]:
+    return _correlation_id.get()
+
+
+def set_correlation_id(correlation_id: Optional[str]) -> contextvars.Token:
+    return _correlation_id.set(correlation_id)
+
+
+def reset_correlation_id(token: contextvars.Token):
+    _correlation_id.reset(token)
+
+
+@contextlib.contextmanager
+def correlation(correlation_id: Optional[str]):
+    token = _correlation_id.set(correlation_id)
+    try:
+        yield correlation_id
+    finally:
+        _correlation_id.reset(token)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.name = name
+        # unique across the processes writing to one file
+        self.span_id = f"{os.getpid()}-{next(_span_ids)}"
+        self.parent_id = parent.span_id if parent else None
+        self.correlation_id = _correlation_id.get()
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = 0.0
+        self.error = None  # type: Optional[str]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(
+            name=self.name, span_id=self.span_id, parent_id=self.parent_id,
+            correlation_id=self.correlation_id, start=self.start, duration=self.duration,
+            error=self.error, **self.attributes,
+        )
+
+
+class JsonLinesExporter:
+    # one JSON object per span per line, appended to path
+    def __init__(self, path: str):
+        self.file = open(path, "a", buffering=1)
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.as_dict(), default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.spans = []  # type: List[Span]
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+
+exporter = None  # type: Optional[Any]
+
+
+def configure(new_exporter) -> Optional[Any]:
+    # returns the exporter it replaces; None turns tracing off
+    global exporter  # pylint: disable=global-statement
+    previous, exporter = exporter, new_exporter
+    return previous
+
+
+def configure_from_file(path: Optional[str]):
+    configure(JsonLinesExporter(path) if path else None)
+
+
+_not_tracing = contextlib.nullcontext()
+
+
+def span(name: str, **attributes):
+    # a no-op, apart from this check, until an exporter is configured
+    if exporter is None:
+        return _not_tracing
+    return _recorded_span(name, attributes)
+
+
+@contextlib.contextmanager
+def _recorded_span(name: str, attributes: Dict[str, Any]):
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current_span.reset(token)
+        if exporter is not None:
+            exporter.export(current)
@@ -12,6 +12,10 @@ def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
                 JOIN batches AS b ON a.batch_id = b.id
                 JOIN order_lines AS ol ON a.orderline_id = ol.id
                 WHERE ol.orderid = :orderid
+                UNION ALL
+                SELECT sku, batchref
+                FROM archived_allocations
+                WHERE orderid = :orderid
                 """
             ),
             dict(orderid=orderid),
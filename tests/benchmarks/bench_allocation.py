@@ -0,0 +1,48 @@
+import itertools
+import timeit
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def batch_with_allocations(n):
+    batch = Batch("batch-001", "BENCH-LAMP", qty=n + 1000, eta=None)
+    for i in range(n):
+        batch.allocate(OrderLine(f"order-{i}", "BENCH-LAMP", 1))
+    return batch
+
+
+def time_can_allocate(n, repeat=1000):
+    batch = batch_with_allocations(n)
+    line = OrderLine("order-new", "BENCH-LAMP", 1)
+    return min(timeit.repeat(lambda: batch.can_allocate(line), number=repeat, repeat=5)) / repeat
+
+
+def product_with_batches(n):
+    start = date(2011, 1, 1)
+    batches = [
+        Batch(f"batch-{i}", "BENCH-LAMP", qty=1_000_000, eta=start + timedelta(days=i))
+        for i in reversed(range(n))
+    ]
+    return Product("BENCH-LAMP", batches)
+
+
+def time_product_allocate(n, repeat=1000):
+    product = product_with_batches(n)
+    orderids = (f"order-{i}" for i in itertools.count())
+    allocate = lambda: product.allocate(OrderLine(next(orderids), "BENCH-LAMP", 1))
+    allocate()  # builds the batch index
+    return min(timeit.repeat(allocate, number=repeat, repeat=5)) / repeat
+
+
+def main():
+    print(f"{'allocations':>12} {'can_allocate (us)':>18}")
+    for n in (10, 1_000, 10_000, 100_000):
+        print(f"{n:>12} {time_can_allocate(n) * 1e6:>18.2f}")
+    print()
+    print(f"{'batches':>12} {'Product.allocate (us)':>22}")
+    for n in (10, 1_000, 10_000):
+        print(f"{n:>12} {time_product_allocate(n) * 1e6:>22.2f}")
+
+
+if __name__ == "__main__":
+    main()
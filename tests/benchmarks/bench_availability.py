@@ -0,0 +1,50 @@
+import timeit
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def fragmented_product(n, vectorize):
+    # every batch but the last has a little stock left, too little for the line
+    start = date(2011, 1, 1)
+    batches = [Batch(f"batch-{i}", "BENCH-LAMP", qty=5, eta=start + timedelta(days=i)) for i in range(n - 1)]
+    batches.append(Batch("big-batch", "BENCH-LAMP", qty=1_000, eta=None if n == 1 else start + timedelta(days=n)))
+    product = Product("BENCH-LAMP", batches)
+    product.vectorize_from = 0 if vectorize else float("inf")
+    product._index_batches()
+    return product
+
+
+def stocked_product(n, vectorize):
+    # the common case: the first open batch has room for the line
+    start = date(2011, 1, 1)
+    batches = [Batch(f"batch-{i}", "BENCH-LAMP", qty=1_000_000, eta=start + timedelta(days=i)) for i in range(n)]
+    product = Product("BENCH-LAMP", batches)
+    product.vectorize_from = 0 if vectorize else float("inf")
+    product._index_batches()
+    return product
+
+
+def time_us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    line = OrderLine("order-1", "BENCH-LAMP", 10)
+    print(f"{'batches':>8} {'path':>7} {'first fit, stocked (us)':>24} "
+          f"{'first fit, fragmented (us)':>27} {'total available (us)':>21}")
+    for n in (10, 1_000, 100_000):
+        number = 1000 if n < 100_000 else 10
+        for vectorize in (False, True):
+            stocked = stocked_product(n, vectorize)
+            assert stocked._first_batch_for(line).reference == "batch-0"
+            common = time_us(lambda: stocked._first_batch_for(line), number)
+            product = fragmented_product(n, vectorize)
+            assert product._first_batch_for(line).reference == "big-batch"
+            first_fit = time_us(lambda: product._first_batch_for(line), number)
+            total = time_us(lambda: product.available_quantity, number)
+            path = "numpy" if vectorize else "objects"
+            print(f"{n:>8} {path:>7} {common:>24.1f} {first_fit:>27.1f} {total:>21.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import tracemalloc
+from dataclasses import fields, make_dataclass
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation.adapters import orm
+from allocation.domain import commands, events
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+N = 100_000
+
+
+def with_dict(cls):
+    # the same dataclass without __slots__, as these classes used to be
+    return make_dataclass(cls.__name__, [(f.name, f.type) for f in fields(cls)])
+
+
+def bytes_each(make, n=N):
+    tracemalloc.start()
+    objects = [make(i) for i in range(n)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size / n
+
+
+def bytes_per_allocated_line(n=N):
+    tracemalloc.start()
+    product = Product("BENCH-LAMP", [Batch("batch-001", "BENCH-LAMP", qty=n, eta=None)])
+    product.allocate_many([OrderLine(f"order-{i}", "BENCH-LAMP", 1) for i in range(n)])
+    product.events.clear()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / n
+
+
+def bytes_per_loaded_line(session_factory, interned, n=N):
+    # lines as the repository gets them: loaded through the ORM, which makes
+    # a new sku string for every row unless the load listener interns it
+    if not interned:
+        event.remove(OrderLine, "load", orm.receive_line_load)
+    try:
+        with session_factory() as session:
+            tracemalloc.start()
+            lines = session.query(OrderLine).all()
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert len(lines) == n
+    finally:
+        if not interned:
+            event.listen(OrderLine, "load", orm.receive_line_load)
+    return size / n
+
+
+def loaded_lines_db(n=N):
+    engine = create_engine("sqlite://")
+    orm.mapper_registry.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(orm.order_lines.insert(), [dict(orderid=f"order-{i}", sku="BENCH-LAMP", qty=1) for i in range(n)])
+    return sessionmaker(bind=engine)
+
+
+def main():
+    cases = [
+        ("Allocated", events.Allocated, lambda cls, i: cls(f"order-{i}", "BENCH-LAMP", 1, "batch-001")),
+        ("OutOfStock", events.OutOfStock, lambda cls, i: cls(f"BENCH-LAMP-{i}")),
+        ("Allocate", commands.Allocate, lambda cls, i: cls(f"order-{i}", "BENCH-LAMP", 1)),
+        ("CreateBatch", commands.CreateBatch, lambda cls, i: cls(f"batch-{i}", "BENCH-LAMP", 1, None)),
+    ]
+    print(f"{'bytes per object':<18} {'with __dict__':>14} {'with __slots__':>15}")
+    for name, cls, make in cases:
+        dict_cls = with_dict(cls)
+        before = bytes_each(lambda i: make(dict_cls, i))
+        after = bytes_each(lambda i: make(cls, i))
+        print(f"{name:<18} {before:>14.0f} {after:>15.0f}")
+    print()
+    print(f"bytes per OrderLine made in memory: {bytes_each(lambda i: OrderLine(f'order-{i}', 'BENCH-LAMP', 1)):.0f}")
+    orm.start_mappers()
+    try:
+        session_factory = loaded_lines_db()
+        before = bytes_per_loaded_line(session_factory, interned=False)
+        after = bytes_per_loaded_line(session_factory, interned=True)
+    finally:
+        clear_mappers()
+    print(f"bytes per OrderLine loaded by the ORM: {before:.0f} with a sku string each, {after:.0f} interned")
+    print(f"bytes per line allocated in a Product: {bytes_per_allocated_line():.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import json
+import statistics
+import time
+from datetime import datetime
+import redis
+from sqlalchemy import create_engine, delete
+from sqlalchemy.orm import sessionmaker
+from allocation import config
+from allocation.adapters import orm
+from allocation.entrypoints import outbox_relay
+
+
+EVENTS = 10_000
+
+
+def fill_outbox(session_factory, n):
+    payload = json.dumps({"orderid": "order-1", "sku": "BENCH-LAMP", "qty": 1, "batchref": "batch-1"})
+    with session_factory() as session:
+        session.execute(delete(orm.outbox))
+        now = datetime.now()
+        session.execute(
+            orm.outbox.insert(),
+            [dict(channel="bench_line_allocated", payload=payload, created_at=now) for _ in range(n)],
+        )
+        session.commit()
+
+
+def time_direct_publish(client, n):
+    payload = json.dumps({"orderid": "order-1", "sku": "BENCH-LAMP", "qty": 1, "batchref": "batch-1"})
+    start = time.perf_counter()
+    for _ in range(n):
+        client.publish("bench_line_allocated", payload)
+    return time.perf_counter() - start
+
+
+def time_relay(session_factory, client, n, batch_size):
+    # the outbox is filled all at once, so lag here is how long the relay
+    # takes to work through a backlog of n events
+    fill_outbox(session_factory, n)
+    lags = []
+    start = time.perf_counter()
+    while True:
+        with session_factory() as session:
+            relayed = outbox_relay.relay_batch(session, client, batch_size)
+        if not relayed:
+            break
+        now = datetime.now()
+        lags.extend((now - created_at).total_seconds() for created_at in relayed)
+    return time.perf_counter() - start, lags
+
+
+def main():
+    engine = create_engine(config.get_postgres_uri())
+    orm.mapper_registry.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    client = redis.Redis(**config.get_redis_host_and_port())
+
+    elapsed = time_direct_publish(client, EVENTS)
+    print(f"{'path':>18} {'events/s':>10} {'p50 lag (ms)':>13} {'p99 lag (ms)':>13}")
+    print(f"{'publish per event':>18} {EVENTS / elapsed:>10.0f} {'':>13} {'':>13}")
+    for batch_size in (1, 100, 500, 2_000):
+        elapsed, lags = time_relay(session_factory, client, EVENTS, batch_size)
+        p50, p99 = (q * 1e3 for q in statistics.quantiles(lags, n=100)[49::49])
+        print(f"{f'relay, batch {batch_size}':>18} {EVENTS / elapsed:>10.0f} {p50:>13.1f} {p99:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from allocation import views
+from allocation.adapters import orm, repository
+from allocation.service_layer import unit_of_work
+
+
+SKUS = 2_000
+BATCHES_PER_SKU = 20
+LINES_PER_BATCH = 5
+CALLS = 200
+
+
+def seed(engine):
+    batch_count = SKUS * BATCHES_PER_SKU
+    with engine.begin() as conn:
+        conn.execute(orm.products.insert(), [dict(sku=f"SKU-{s}", version_number=1) for s in range(SKUS)])
+        conn.execute(orm.batches.insert(), [
+            dict(id=b, reference=f"batch-{b}", sku=f"SKU-{b // BATCHES_PER_SKU}", _purchased_quantity=1000)
+            for b in range(batch_count)
+        ])
+        lines = range(batch_count * LINES_PER_BATCH)
+        conn.execute(orm.order_lines.insert(), [
+            dict(id=l, orderid=f"order-{l // 3}", sku=f"SKU-{l // LINES_PER_BATCH // BATCHES_PER_SKU}", qty=1)
+            for l in lines
+        ])
+        conn.execute(orm.allocations.insert(), [dict(orderline_id=l, batch_id=l // LINES_PER_BATCH) for l in lines])
+
+
+def seeded_engine(path, indexed):
+    engine = create_engine(f"sqlite:///{path}")
+    orm.mapper_registry.metadata.create_all(engine)
+    if not indexed:
+        for table in orm.mapper_registry.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(engine)
+    seed(engine)
+    return engine
+
+
+def allocations_view(session_factory, rng):
+    views.allocations(f"order-{rng.randrange(SKUS * BATCHES_PER_SKU * LINES_PER_BATCH // 3)}",
+                      unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+
+def sku_for_batchref(session_factory, rng):
+    with session_factory() as session:
+        repository.SqlAlchemyRepository(session).sku_for_batchref(f"batch-{rng.randrange(SKUS * BATCHES_PER_SKU)}")
+
+
+def load_product(session_factory, rng):
+    with session_factory() as session:
+        product = repository.SqlAlchemyRepository(session).get(f"SKU-{rng.randrange(SKUS)}")
+        assert len(product.batches) == BATCHES_PER_SKU
+
+
+QUERIES = {
+    "views.allocations": allocations_view,
+    "sku_for_batchref": sku_for_batchref,
+    "load product": load_product,
+}
+
+
+def time_query(query, session_factory):
+    rng = random.Random(42)
+    timings = []
+    for _ in range(CALLS):
+        start = time.perf_counter()
+        query(session_factory, rng)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def query_plans(query, engine, session_factory):
+    # the plan of every statement the query runs
+    statements = []
+
+    def record(conn, cursor, statement, parameters, *_):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        query(session_factory, random.Random(42))
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    with engine.connect() as conn:
+        return [
+            [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+            for statement, parameters in statements
+        ]
+
+
+def main():
+    orm.start_mappers()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for indexed in (False, True):
+            engine = seeded_engine(os.path.join(tmp, f"allocation-{indexed}.db"), indexed)
+            session_factory = sessionmaker(bind=engine)
+            for name, query in QUERIES.items():
+                results[name, indexed] = (
+                    time_query(query, session_factory), query_plans(query, engine, session_factory)
+                )
+            engine.dispose()
+
+    lines = SKUS * BATCHES_PER_SKU * LINES_PER_BATCH
+    print(f"{SKUS} skus, {SKUS * BATCHES_PER_SKU} batches, {lines} allocated lines")
+    print(f"{'query':>18} {'no indexes (ms)':>16} {'indexes (ms)':>13}")
+    for name in QUERIES:
+        print(f"{name:>18} {results[name, False][0] * 1e3:>16.3f} {results[name, True][0] * 1e3:>13.3f}")
+    for name in QUERIES:
+        for indexed in (False, True):
+            print()
+            print(f"{name}, {'with' if indexed else 'without'} indexes:")
+            for i, plan in enumerate(results[name, indexed][1], start=1):
+                for step in plan:
+                    print(f"  {i}. {step}")
+
+
+if __name__ == "__main__":
+    main()
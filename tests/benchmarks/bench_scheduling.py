@@ -0,0 +1,115 @@
+import random
+import statistics
+import time
+from typing import Dict
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+
+COMMANDS = 2_000
+HOT_SHARE = 0.8
+COLD_SKUS = 50
+COMMIT_SECONDS = 0.001
+
+
+class MemoryRepository(repository.AbstractProductRepository):
+    def __init__(self):
+        super().__init__()
+        self._products = {}  # type: Dict[str, model.Product]
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+    def _get_by_batchref(self, batchref):
+        return next((p for p in self._products.values() for b in p.batches if b.reference == batchref), None)
+
+    def _archive(self, batches):
+        pass
+
+
+class TimedUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    # every commit costs COMMIT_SECONDS, like a round trip to the database,
+    # and marks the commands handled since the last one as done
+    def __init__(self):
+        self.products = MemoryRepository()
+        self.handled = []
+        self.done = {}
+
+    def _commit(self):
+        time.sleep(COMMIT_SECONDS)
+        now = time.perf_counter()
+        for command in self.handled:
+            self.done[id(command)] = now
+        self.handled.clear()
+
+    def rollback(self):
+        pass
+
+
+def bus_for(priorities, skus):
+    uow = TimedUnitOfWork()
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=uow, notifications=None, publish=lambda *args: None,
+        priorities=priorities,
+    )
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 1_000_000, None))
+    for command_type, handler in list(bus.command_handlers.items()):
+        def timed(command, handler=handler):
+            uow.handled.append(command)
+            return handler(command)
+        bus.command_handlers[command_type] = timed
+    # only the commands are timed, the read model and publishing are left out
+    bus.event_handlers = {event_type: [] for event_type in bus.event_handlers}
+    return bus
+
+
+def skewed_workload(rng):
+    cold = [f"COLD-{i}" for i in range(COLD_SKUS)]
+    messages = []
+    for i in range(COMMANDS):
+        sku = "HOT-LAMP" if rng.random() < HOT_SHARE else rng.choice(cold)
+        if rng.random() < 0.05:
+            messages.append(commands.ChangeBatchQuantity(f"{sku}-batch", 1_000_000 + i))
+        else:
+            messages.append(commands.Allocate(f"order-{i}", sku, 1))
+    return ["HOT-LAMP"] + cold, messages
+
+
+def time_handle_many(priorities, skus, messages):
+    bus = bus_for(priorities, skus)
+    start = time.perf_counter()
+    bus.handle_many(messages)
+    latencies = {}
+    for message in messages:
+        latencies.setdefault(message.sku if isinstance(message, commands.Allocate) else "change", []).append(
+            bus.uow.done[id(message)] - start
+        )
+    return latencies
+
+
+def quantiles(latencies):
+    p50, p99 = (q * 1e3 for q in statistics.quantiles(latencies, n=100)[49::49])
+    return p50, p99
+
+
+def main():
+    skus, messages = skewed_workload(random.Random(42))
+    print(f"{'schedule':>10} {'commands':>14} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for name, priorities in (("fifo", None), ("priority", handlers.PRIORITIES)):
+        latencies = time_handle_many(priorities, skus, messages)
+        hot = latencies.pop("HOT-LAMP")
+        change = latencies.pop("change")
+        cold = [latency for sku_latencies in latencies.values() for latency in sku_latencies]
+        for label, values in (("hot allocate", hot), ("cold allocate", cold), ("change qty", change)):
+            p50, p99 = quantiles(values)
+            print(f"{name:>10} {label:>14} {p50:>9.1f} {p99:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,10 +10,16 @@ import requests
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
-from allocation.adapters.orm import mapper_registry, start_mappers
+from allocation.adapters.orm import mapper_registry, migrate, start_mappers
+from allocation.domain import model
 from allocation import config
 
 
+@pytest.fixture(autouse=True)
+def verify_allocated_quantities(monkeypatch):
+    monkeypatch.setattr(model.Batch, "verify_allocated_quantity", True)
+
+
 @pytest.fixture
 def in_memory_db():
     engine = create_engine("sqlite:///:memory:")
@@ -58,7 +64,7 @@ def wait_for_redis_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri())
     wait_for_postgres_to_come_up(engine)
-    mapper_registry.metadata.create_all(engine)
+    migrate(engine)
     return engine
 
 
@@ -31,6 +31,21 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_bulk_allocate(lines):
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/bulk_allocate",
+        json={
+            "lines": [
+                {"orderid": orderid, "sku": sku, "qty": qty}
+                for orderid, sku, qty in lines
+            ],
+        },
+    )
+    assert r.status_code == 202
+    return r
+
+
 def post_to_deallocate(orderid, sku, qty, expect_success=True):
     url = config.get_api_url()
     r = requests.post(
@@ -46,6 +61,11 @@ def post_to_deallocate(orderid, sku, qty, expect_success=True):
     return r
 
 
-def get_allocation(orderid):
+def get_allocation(orderid, correlation_id=None):
+    url = config.get_api_url()
+    headers = {"X-Correlation-ID": correlation_id} if correlation_id else {}
+    return requests.get(f"{url}/allocations/{orderid}", headers=headers)
+
+def get_metrics():
     url = config.get_api_url()
-    return requests.get(f"{url}/allocations/{orderid}")
\ No newline at end of file
+    return requests.get(f"{url}/metrics")
@@ -70,4 +70,42 @@ def test_deallocate():
 
     r = api_client.get_allocation(order2)
     assert r.ok
-    assert r.json() == [{"sku": sku, "batchref": batch}]
\ No newline at end of file
+    assert r.json() == [{"sku": sku, "batchref": batch}]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocate_returns_a_result_per_line():
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    order1, order2 = random_orderid(1), random_orderid(2)
+    batch = random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+
+    r = api_client.post_to_bulk_allocate(
+        [(order1, sku, 10), (order2, unknown_sku, 10), (order2, sku, 10)]
+    )
+    assert r.json() == [
+        {"batchref": batch},
+        {"message": f"Invalid sku {unknown_sku}"},
+        {"batchref": batch},
+    ]
+
+    r = api_client.get_allocation(order2)
+    assert r.ok
+    assert r.json() == [{"sku": sku, "batchref": batch}]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_metrics_count_handled_commands():
+    api_client.post_to_add_batch(random_batchref(), random_sku(), 100, None)
+
+    r = api_client.get_metrics()
+    assert r.ok
+    assert 'allocation_command_seconds_count{command="CreateBatch"} 1' in r.text
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_echoes_the_callers_correlation_id():
+    r = api_client.get_allocation(random_orderid(), correlation_id="abc123")
+    assert r.headers["X-Correlation-ID"] == "abc123"
@@ -0,0 +1,92 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import functools
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation import bootstrap
+from allocation.adapters import notifications
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+pytest.importorskip("aiosqlite")
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine  # pylint: disable=wrong-import-position
+
+
+class FakeNotifications(notifications.AbstractNotifications):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, destination, message):
+        self.sent.append((destination, message))
+
+
+@pytest.fixture
+def async_session_factory(tmp_path):
+    db_file = tmp_path / "allocation.db"
+    mapper_registry.metadata.create_all(create_engine(f"sqlite:///{db_file}"))
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_file}")
+    yield sessionmaker(bind=engine, class_=AsyncSession)
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def async_bus(async_session_factory):
+    published = []
+
+    async def publish(channel, event):
+        published.append((channel, event))
+
+    bus = bootstrap.bootstrap_async(
+        start_orm=True,
+        uow_factory=functools.partial(unit_of_work.AsyncSqlAlchemyUnitOfWork, async_session_factory),
+        notifications=FakeNotifications(),
+        publish=publish,
+    )
+    bus.published = published
+    yield bus
+    clear_mappers()
+
+
+def test_allocates_through_the_async_bus(async_bus):
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+
+    async def run():
+        await async_bus.handle(commands.CreateBatch(batchref, sku, 100, None))
+        return await async_bus.handle(commands.Allocate(orderid, sku, 10))
+
+    [allocated_ref] = asyncio.run(run())
+    assert allocated_ref == batchref
+    assert [channel for channel, _ in async_bus.published] == ["batch_created", "line_allocated"]
+
+
+def test_concurrent_commands_for_different_skus(async_bus):
+    skus = [random_sku(str(i)) for i in range(5)]
+
+    async def run():
+        await asyncio.gather(*(
+            async_bus.handle(commands.CreateBatch(random_batchref(sku), sku, 100, None))
+            for sku in skus
+        ))
+        return await asyncio.gather(*(
+            async_bus.handle(commands.Allocate(random_orderid(), sku, 10))
+            for sku in skus
+        ))
+
+    results = asyncio.run(run())
+    assert all(batchref.startswith("batch-") for [batchref] in results)
+
+
+def test_rolls_back_uncommitted_work_by_default(async_session_factory):
+    async def run():
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+        async with uow:
+            await uow.session.execute(
+                text("INSERT INTO products (sku, version_number) VALUES ('MEDIUM-PLINTH', 1)")
+            )
+        async with uow:
+            return list(await uow.session.execute(text("SELECT * FROM products")))
+
+    assert asyncio.run(run()) == []
@@ -0,0 +1,85 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest import mock
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import text
+from allocation import bootstrap
+from allocation.adapters.idempotency import SqlAlchemyIdempotencyStore
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+
+def test_results_survive_a_new_store(sqlite_session_factory):
+    SqlAlchemyIdempotencyStore(sqlite_session_factory).put("Allocate:key1", ["batch1", None])
+    store = SqlAlchemyIdempotencyStore(sqlite_session_factory)
+    assert store.get("Allocate:key1") == (True, ["batch1", None])
+    assert store.get("Allocate:key2") == (False, None)
+
+
+def test_expired_keys_can_be_reused(sqlite_session_factory):
+    store = SqlAlchemyIdempotencyStore(sqlite_session_factory, ttl=60)
+    store.put("Allocate:key1", "batch1")
+    session = sqlite_session_factory()
+    session.execute(
+        text("UPDATE idempotency_keys SET created_at = :then"),
+        dict(then=datetime.now() - timedelta(seconds=61)),
+    )
+    session.commit()
+
+    store = SqlAlchemyIdempotencyStore(sqlite_session_factory, ttl=60)
+    assert store.get("Allocate:key1") == (False, None)
+    store.put("Allocate:key1", "batch2")
+    assert SqlAlchemyIdempotencyStore(sqlite_session_factory, ttl=60).get("Allocate:key1") == (True, "batch2")
+
+
+def test_purges_expired_rows(sqlite_session_factory):
+    store = SqlAlchemyIdempotencyStore(sqlite_session_factory, ttl=60, purge_every=2)
+    store.put("Allocate:old", "batch1")
+    session = sqlite_session_factory()
+    session.execute(
+        text("UPDATE idempotency_keys SET created_at = :then"),
+        dict(then=datetime.now() - timedelta(seconds=61)),
+    )
+    session.commit()
+    store.put("Allocate:new", "batch2")
+
+    assert list(session.execute(text("SELECT key FROM idempotency_keys"))) == [("Allocate:new",)]
+
+
+def keyed(command, key):
+    command.idempotency_key = key
+    return command
+
+
+def bootstrap_idempotent_app(session_factory):
+    store = SqlAlchemyIdempotencyStore(session_factory)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=mock.Mock(),
+        publish=mock.Mock(),
+        idempotency_store=store,
+    )
+    bus.handle(commands.CreateBatch("b1", "ONCE-LAMP", 100, None))
+    return bus, store
+
+
+def test_results_are_committed_with_the_command(session_factory):
+    bus, store = bootstrap_idempotent_app(session_factory)
+    with mock.patch.object(store, "put", side_effect=AssertionError("stored in a transaction of its own")):
+        assert bus.handle(keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1")) == ["b1"]
+
+    assert SqlAlchemyIdempotencyStore(session_factory).get("Allocate:key1") == (True, "b1")
+
+
+def test_commands_whose_result_cannot_be_stored_are_rolled_back(session_factory):
+    bus, store = bootstrap_idempotent_app(session_factory)
+    bus.handle(keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1"))
+
+    # another process handled it, but this one didn't see its result in time
+    with mock.patch.object(store, "get", return_value=(False, None)):
+        with pytest.raises(IntegrityError):
+            bus.handle(keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1"))
+
+    with bus.uow:
+        assert bus.uow.products.get("ONCE-LAMP").available_quantity == 90
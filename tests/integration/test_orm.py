@@ -1,5 +1,9 @@
 from datetime import date
+import pytest
+from allocation.adapters import orm
 from allocation.domain import model
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import text
 
 
@@ -101,3 +105,44 @@ def test_retrieving_allocations(session):
     batch = session.query(model.Batch).one()
 
     assert batch._allocations == {model.OrderLine("order1", "sku1", 12)}
+    assert batch.allocated_quantity == 12
+
+
+def test_lines_loaded_for_the_same_sku_share_one_sku_string(session):
+    session.execute(
+        text(
+            "INSERT INTO order_lines (orderid, sku, qty) VALUES "
+            '("order1", "RED-CHAIR", 12),'
+            '("order2", "RED-CHAIR", 13)'
+        )
+    )
+    line1, line2 = session.query(model.OrderLine).all()
+    assert line1.sku is line2.sku
+
+
+def index_names(engine):
+    inspector = inspect(engine)
+    return {index["name"] for table in inspector.get_table_names() for index in inspector.get_indexes(table)}
+
+
+def test_migrate_adds_indexes_to_existing_tables():
+    engine = create_engine("sqlite:///:memory:")
+    orm.mapper_registry.metadata.create_all(engine)
+    for table in orm.mapper_registry.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(engine)
+    assert index_names(engine) == set()
+
+    orm.migrate(engine)
+    orm.migrate(engine)
+
+    assert index_names(engine) >= {
+        "ix_order_lines_orderid_sku", "ix_batches_reference", "ix_batches_sku",
+        "ix_allocations_orderline_id", "ix_allocations_batch_id_orderline_id", "ix_archived_allocations_orderid",
+    }
+
+
+def test_batch_references_are_unique(session):
+    session.execute(text("INSERT INTO batches (reference, sku, _purchased_quantity) VALUES ('batch1', 'LAMP', 10)"))
+    with pytest.raises(IntegrityError):
+        session.execute(text("INSERT INTO batches (reference, sku, _purchased_quantity) VALUES ('batch1', 'RUG', 10)"))
@@ -0,0 +1,131 @@
+# pylint: disable=redefined-outer-name
+import json
+from datetime import date
+import pytest
+import redis
+from sqlalchemy.orm import clear_mappers
+from sqlalchemy.sql import text
+from unittest import mock
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import outbox_relay
+from allocation.service_layer import unit_of_work
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.published = []
+        self.round_trips = 0
+        self.fail = fail
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def publish(self, channel, message):
+        self.commands.append((channel, message))
+
+    def execute(self):
+        self.client.round_trips += 1
+        if self.client.fail:
+            raise redis.ConnectionError("redis is down")
+        self.client.published.extend(self.commands)
+
+
+@pytest.fixture
+def outbox_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=mock.Mock(),
+        use_outbox=True,
+    )
+    yield bus
+    clear_mappers()
+
+
+def outbox_channels(session):
+    return [channel for channel, in session.execute(text("SELECT channel FROM outbox ORDER BY id"))]
+
+
+def test_events_go_to_the_outbox_instead_of_redis(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "OUTBOX-LAMP", 100, None))
+    outbox_bus.handle(commands.Allocate("o1", "OUTBOX-LAMP", 10))
+    outbox_bus.handle_many([
+        commands.Allocate("o2", "OUTBOX-LAMP", 10),
+        commands.Allocate("o3", "OUTBOX-LAMP", 10),
+    ])
+
+    assert outbox_channels(sqlite_session_factory()) == [
+        "batch_created", "line_allocated", "line_allocated", "line_allocated",
+    ]
+
+
+def test_dated_batches_are_written_with_iso_etas(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "OUTBOX-CLOCK", 100, date(2011, 1, 2)))
+
+    session = sqlite_session_factory()
+    [[payload]] = session.execute(text("SELECT payload FROM outbox"))
+    assert json.loads(payload)["eta"] == "2011-01-02"
+    [[ref]] = session.execute(text("SELECT reference FROM batches"))
+    assert ref == "b1"
+
+
+def test_nothing_is_written_for_a_failed_command(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "OUTBOX-RUG", 10, None))
+    with pytest.raises(Exception):
+        outbox_bus.handle(commands.Deallocate("o1", "OUTBOX-RUG", 10))
+    assert outbox_channels(sqlite_session_factory()) == ["batch_created"]
+
+
+def test_relay_publishes_in_one_round_trip_and_clears_the_outbox(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "OUTBOX-CHAIR", 100, None))
+    outbox_bus.handle(commands.Allocate("o1", "OUTBOX-CHAIR", 10))
+    client = FakeRedis()
+
+    relayed = outbox_relay.relay_batch(sqlite_session_factory(), client)
+
+    assert len(relayed) == 2
+    assert client.round_trips == 1
+    [(channel, payload)] = [p for p in client.published if p[0] == "line_allocated"]
+    data = json.loads(payload)
+    assert data.pop("correlation_id")
+    assert data == {"orderid": "o1", "sku": "OUTBOX-CHAIR", "qty": 10, "batchref": "b1"}
+    assert outbox_channels(sqlite_session_factory()) == []
+
+
+def test_relay_keeps_events_it_could_not_publish(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "OUTBOX-TABLE", 100, None))
+    with pytest.raises(redis.ConnectionError):
+        outbox_relay.relay_batch(sqlite_session_factory(), FakeRedis(fail=True))
+    assert outbox_channels(sqlite_session_factory()) == ["batch_created"]
+
+
+def test_relay_publishes_in_batches(outbox_bus, sqlite_session_factory):
+    for i in range(5):
+        outbox_bus.handle(commands.CreateBatch(f"b{i}", "OUTBOX-SOFA", 100, None))
+    client = FakeRedis()
+    assert len(outbox_relay.relay_batch(sqlite_session_factory(), client, batch_size=3)) == 3
+    assert len(outbox_relay.relay_batch(sqlite_session_factory(), client, batch_size=3)) == 2
+    assert [json.loads(payload)["ref"] for _, payload in client.published] == [f"b{i}" for i in range(5)]
+
+
+def test_relay_backs_off_while_redis_is_down(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "OUTBOX-BED", 100, None))
+    client = FakeRedis(fail=True)
+
+    first_wait, failures = outbox_relay.relay_round(sqlite_session_factory, client)
+    second_wait, failures = outbox_relay.relay_round(sqlite_session_factory, client, failures)
+    assert failures == 2
+    assert first_wait < second_wait <= outbox_relay.MAX_BACKOFF
+
+    client.fail = False
+    _, failures = outbox_relay.relay_round(sqlite_session_factory, client, failures)
+    assert failures == 0
+    assert [channel for channel, _ in client.published] == ["batch_created"]
@@ -0,0 +1,110 @@
+import pytest
+from unittest import mock
+from sqlalchemy.sql import text
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+from .test_uow import get_allocated_batch_ref, insert_batch
+
+
+def cached_uow(session_factory, maxsize=10):
+    return unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=repository.ProductCache(maxsize))
+
+
+def allocate(uow, orderid, sku, qty=10):
+    with uow:
+        batchref = uow.products.get(sku).allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+    return batchref
+
+
+def test_committed_products_are_reused(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CACHED-LAMP", 100, None)
+    session.commit()
+    uow = cached_uow(session_factory)
+
+    allocate(uow, "o1", "CACHED-LAMP")
+    allocate(uow, "o2", "CACHED-LAMP")
+
+    assert uow.product_cache.lookups == {"miss": 1, "hit": 1}
+    assert get_allocated_batch_ref(session, "o2", "CACHED-LAMP") == "batch1"
+    [[version]] = session.execute(text("SELECT version_number FROM products"))
+    assert version == 3
+    with uow:
+        assert uow.products.get("CACHED-LAMP").available_quantity == 80
+
+
+def test_products_changed_elsewhere_are_reloaded(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CACHED-LAMP", 100, None)
+    session.commit()
+    uow = cached_uow(session_factory)
+    allocate(uow, "o1", "CACHED-LAMP")
+
+    allocate(unit_of_work.SqlAlchemyUnitOfWork(session_factory), "o2", "CACHED-LAMP", qty=50)
+    allocate(uow, "o3", "CACHED-LAMP")
+
+    assert uow.product_cache.lookups["stale"] == 1
+    with uow:
+        assert uow.products.get("CACHED-LAMP").available_quantity == 30
+
+
+def test_rolled_back_changes_are_not_cached(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CACHED-LAMP", 100, None)
+    session.commit()
+    uow = cached_uow(session_factory)
+    allocate(uow, "o1", "CACHED-LAMP")
+
+    with pytest.raises(ZeroDivisionError):
+        with uow:
+            uow.products.get("CACHED-LAMP").allocate(model.OrderLine("o2", "CACHED-LAMP", 10))
+            1 / 0
+
+    assert len(uow.product_cache) == 0
+    with uow:
+        assert uow.products.get("CACHED-LAMP").available_quantity == 90
+
+
+def test_least_recently_used_products_are_dropped(session_factory):
+    session = session_factory()
+    for sku in ("LAMP", "RUG", "CHAIR"):
+        insert_batch(session, f"{sku}-batch", sku, 100, None)
+    session.commit()
+    uow = cached_uow(session_factory, maxsize=2)
+
+    for sku in ("LAMP", "RUG", "CHAIR", "LAMP"):
+        allocate(uow, f"{sku}-order", sku)
+
+    assert uow.product_cache.lookups == {"miss": 4}
+    assert uow.product_cache.take("RUG") is None
+
+
+def test_warming_loads_the_most_allocated_products(session_factory):
+    session = session_factory()
+    for sku in ("LAMP", "RUG", "CHAIR"):
+        insert_batch(session, f"{sku}-batch", sku, 100, None)
+    session.commit()
+    uow = cached_uow(session_factory)
+    for i, sku in enumerate(["RUG", "RUG", "LAMP", "CHAIR", "RUG", "CHAIR"]):
+        allocate(unit_of_work.SqlAlchemyUnitOfWork(session_factory), f"o{i}", sku)
+
+    uow.warm_product_cache(limit=2)
+
+    assert sorted(uow.product_cache.take(sku).sku for sku in ("RUG", "CHAIR")) == ["CHAIR", "RUG"]
+    assert uow.product_cache.take("LAMP") is None
+
+
+def test_only_real_cache_lookups_are_counted(session_factory):
+    uow = cached_uow(session_factory)
+    bus = bootstrap.bootstrap(start_orm=False, uow=uow, notifications=mock.Mock(), publish=mock.Mock())
+    bus.handle(commands.CreateBatch("batch1", "CACHED-LAMP", 100, None))
+
+    bus.handle_many([commands.Allocate(f"o{i}", "CACHED-LAMP", 1) for i in range(5)])
+    with uow:
+        assert uow.products.get("NO-SUCH-LAMP") is None
+        assert uow.products.get("NO-SUCH-LAMP") is None
+
+    assert uow.product_cache.lookups == {"miss": 2, "hit": 1}
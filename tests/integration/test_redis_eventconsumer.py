@@ -0,0 +1,20 @@
+from sqlalchemy.sql import text
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from allocation.service_layer import unit_of_work
+
+
+def test_partitioner_looks_up_batch_skus_without_the_mappers(sqlite_session_factory):
+    # the consumer's parent process only partitions, so it never starts them
+    session = sqlite_session_factory()
+    session.execute(text("INSERT INTO products (sku) VALUES ('PARTITIONED-LAMP')"))
+    session.execute(text(
+        "INSERT INTO batches (reference, sku, _purchased_quantity) VALUES ('b1', 'PARTITIONED-LAMP', 10)"
+    ))
+    session.commit()
+    partitioner = redis_eventconsumer.Partitioner(4, unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory))
+
+    assert partitioner.sku_for(commands.ChangeBatchQuantity("b1", 5)) == "PARTITIONED-LAMP"
+    assert partitioner.worker_for(commands.ChangeBatchQuantity("b1", 5)) == partitioner.worker_for(
+        commands.Allocate("o1", "PARTITIONED-LAMP", 1)
+    )
@@ -1,5 +1,7 @@
+import pytest
 from allocation.domain import model
 from allocation.adapters import repository
+from sqlalchemy import event
 from sqlalchemy.sql import text
 
 
@@ -85,3 +87,83 @@ def test_repository_can_retrieve_a_batch_with_allocations(session):
     assert retrieved._allocations == {
         model.OrderLine("order1", "GENERIC-SOFA", 12),
     }
+
+
+def test_repository_remembers_which_sku_a_batchref_belongs_to(session):
+    insert_product(session, "GENERIC-SOFA")
+    insert_batch(session, "batch1")
+    batchref_skus = repository.BatchrefSkus()
+
+    repo = repository.SqlAlchemyRepository(session, batchref_skus)
+    assert repo.get_by_batchref("batch1").sku == "GENERIC-SOFA"
+    assert batchref_skus.get("batch1") == "GENERIC-SOFA"
+    assert repo.get_by_batchref("no-such-batch") is None
+
+    another_repo = repository.SqlAlchemyRepository(session, batchref_skus)
+    assert another_repo.get_by_batchref("batch1").sku == "GENERIC-SOFA"
+
+
+def product_with_allocated_batches(session, sku, n):
+    product = model.Product(sku, [model.Batch(f"{sku}-batch{i}", sku, 100, eta=None) for i in range(n)])
+    for i, batch in enumerate(product.batches):
+        batch.allocate(model.OrderLine(f"{sku}-order{i}", sku, 1))
+        batch.allocate(model.OrderLine(f"{sku}-order{i}-2", sku, 2))
+    session.add(product)
+    session.commit()
+    session.expunge_all()
+
+
+def statements_to_load(session, sku, loading):
+    statements = []
+    engine = session.get_bind()
+
+    def record(conn, cursor, statement, *_):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        product = repository.SqlAlchemyRepository(session, loading=loading).get(sku)
+        assert sum(batch.allocated_quantity for batch in product.batches) == 3 * len(product.batches)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return len(statements)
+
+
+@pytest.mark.parametrize("loading", ["selectin", "joined"])
+def test_loading_a_product_takes_the_same_number_of_queries_for_any_number_of_batches(session, loading):
+    for n in (1, 10, 50):
+        product_with_allocated_batches(session, f"SOFA-{n}", n)
+
+    counts = [statements_to_load(session, f"SOFA-{n}", loading) for n in (1, 10, 50)]
+
+    assert counts == [counts[0]] * 3
+    assert counts[0] == {"selectin": 3, "joined": 1}[loading]
+
+
+def test_lazy_loading_takes_a_query_per_batch(session):
+    for n in (1, 10):
+        product_with_allocated_batches(session, f"SOFA-{n}", n)
+
+    assert statements_to_load(session, "SOFA-10", "lazy") - statements_to_load(session, "SOFA-1", "lazy") == 9
+
+
+def test_unknown_loading_strategies_are_rejected(session):
+    with pytest.raises(ValueError):
+        repository.SqlAlchemyRepository(session, loading="eager")
+
+
+def test_a_product_is_only_loaded_once_per_session(session):
+    product_with_allocated_batches(session, "SOFA-3", 3)
+    repo = repository.SqlAlchemyRepository(session)
+    product = repo.get("SOFA-3")
+    statements = []
+
+    def record(conn, cursor, statement, *_):
+        statements.append(statement)
+
+    event.listen(session.get_bind(), "before_cursor_execute", record)
+    try:
+        assert repo.get("SOFA-3") is product
+    finally:
+        event.remove(session.get_bind(), "before_cursor_execute", record)
+    assert statements == []
@@ -3,8 +3,11 @@ import pytest
 import threading
 import time
 import traceback
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
 from sqlalchemy.sql import text
 from typing import List
+from allocation.adapters.orm import mapper_registry, start_mappers
 from allocation.domain import model
 from allocation.service_layer import unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
@@ -84,6 +87,34 @@ def test_rolls_back_on_error(session_factory):
     assert rows == []
 
 
+def test_stale_versions_are_not_written(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    mapper_registry.metadata.create_all(engine)
+    start_mappers()
+    try:
+        session_factory = sessionmaker(bind=engine)
+        session = session_factory()
+        insert_batch(session, "batch1", "STALE-LAMP", 100, eta=None, product_version=1)
+        session.commit()
+
+        uow1 = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        uow2 = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        with uow1:
+            product1 = uow1.products.get(sku="STALE-LAMP")
+            with uow2:
+                uow2.products.get(sku="STALE-LAMP").allocate(model.OrderLine("o2", "STALE-LAMP", 10))
+                uow2.commit()
+            product1.allocate(model.OrderLine("o1", "STALE-LAMP", 10))
+            with pytest.raises(unit_of_work.ConcurrencyError):
+                uow1.commit()
+
+        [[version]] = session.execute(text("SELECT version_number FROM products"))
+        assert version == 2
+        assert get_allocated_batch_ref(session, "o2", "STALE-LAMP") == "batch1"
+    finally:
+        clear_mappers()
+
+
 def try_to_allocate(orderid, sku, exceptions):
     line = model.OrderLine(orderid, sku, 10)
     try:
@@ -122,6 +153,7 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     )
     assert version == 2
     [exception] = exceptions
+    assert isinstance(exception, unit_of_work.ConcurrencyError)
     assert "could not serialize access due to concurrent update" in str(exception)
 
     orders = session.execute(
@@ -1,6 +1,7 @@
 import pytest
 from datetime import date
 from sqlalchemy.orm import clear_mappers
+from sqlalchemy.sql import text
 from unittest import mock
 from allocation import bootstrap, views
 from allocation.domain import commands
@@ -46,4 +47,18 @@ def test_deallocation(sqlite_bus):
 
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
-    ]
\ No newline at end of file
+    ]
+
+def test_archived_allocations_stay_in_the_view(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 20, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 20))
+    sqlite_bus.handle(commands.Allocate("o2", "sku1", 20))
+    sqlite_bus.handle(commands.ArchiveBatches("sku1", as_of=today))
+
+    with sqlite_bus.uow as uow:
+        assert [b.reference for b in uow.products.get("sku1").batches] == ["b2"]
+        [[live_lines]] = uow.session.execute(text("SELECT count(*) FROM order_lines"))
+        assert live_lines == 1
+    assert views.allocations("o1", sqlite_bus.uow) == [{"sku": "sku1", "batchref": "b1"}]
+    assert views.allocations("o2", sqlite_bus.uow) == [{"sku": "sku1", "batchref": "b2"}]
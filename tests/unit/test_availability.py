@@ -0,0 +1,62 @@
+import pytest
+from datetime import date, timedelta
+from allocation.domain.model import Product, OrderLine, Batch
+
+pytest.importorskip("numpy")
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+later = tomorrow + timedelta(days=10)
+
+
+@pytest.fixture(autouse=True)
+def vectorize_every_product(monkeypatch):
+    monkeypatch.setattr(Product, "vectorize_from", 0)
+
+
+def test_prefers_warehouse_batches_then_earlier_batches():
+    product = Product(
+        sku="RETRO-CLOCK",
+        batches=[
+            Batch("slow-batch", "RETRO-CLOCK", 100, eta=later),
+            Batch("speedy-batch", "RETRO-CLOCK", 100, eta=today),
+            Batch("in-stock-batch", "RETRO-CLOCK", 100, eta=None),
+        ],
+    )
+    assert product.allocate(OrderLine("order1", "RETRO-CLOCK", 10)) == "in-stock-batch"
+    assert product._availability is not None
+
+
+def test_skips_batches_too_small_for_the_line():
+    product = Product(
+        sku="SMALL-FORK",
+        batches=[
+            Batch("small-batch", "SMALL-FORK", 5, eta=None),
+            Batch("first-big-batch", "SMALL-FORK", 50, eta=tomorrow),
+            Batch("second-big-batch", "SMALL-FORK", 50, eta=tomorrow),
+        ],
+    )
+    assert product.allocate(OrderLine("order1", "SMALL-FORK", 10)) == "first-big-batch"
+    assert product.allocate(OrderLine("order2", "SMALL-FORK", 5)) == "small-batch"
+    assert product.allocate(OrderLine("order3", "SMALL-FORK", 1)) == "first-big-batch"
+
+
+def test_stays_in_step_with_the_batches():
+    product = Product(sku="BUSY-LAMP", batches=[Batch("batch1", "BUSY-LAMP", 10, eta=None)])
+    line = OrderLine("order1", "BUSY-LAMP", 10)
+    product.allocate(line)
+    assert product.available_quantity == 0
+    assert product.allocate(OrderLine("order2", "BUSY-LAMP", 1)) is None
+
+    product.add_batch(Batch("batch2", "BUSY-LAMP", 20, eta=tomorrow))
+    assert product.available_quantity == 20
+    product.deallocate(line)
+    assert product.available_quantity == 30
+    product.change_batch_quantity("batch2", 5)
+    assert product.available_quantity == 15
+    assert product.allocate(OrderLine("order3", "BUSY-LAMP", 8)) == "batch1"
+
+
+def test_cannot_allocate_lines_for_another_sku():
+    product = Product(sku="RED-LAMP", batches=[Batch("batch1", "RED-LAMP", 10, eta=None)])
+    assert product.allocate(OrderLine("order1", "BLUE-LAMP", 1)) is None
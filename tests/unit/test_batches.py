@@ -1,3 +1,4 @@
+import pytest
 from datetime import date
 from allocation.domain.model import Batch, OrderLine
 
@@ -57,3 +58,19 @@ def test_can_only_deallocate_allocated_lines():
     batch, unallocated_line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
     batch.deallocate(unallocated_line)
     assert batch.available_quantity == 20
+
+
+def test_deallocate_one_reduces_the_allocated_quantity():
+    batch, line = make_batch_and_line("SQUEAKY-CHAIR", 20, 2)
+    batch.allocate(line)
+    assert batch.deallocate_one() == line
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_check_catches_lines_changed_behind_its_back():
+    batch, line = make_batch_and_line("WOBBLY-SHELF", 20, 2)
+    batch.allocate(line)
+    batch._allocations.add(OrderLine("order-456", "WOBBLY-SHELF", 5))
+    with pytest.raises(AssertionError):
+        batch.allocated_quantity
@@ -0,0 +1,80 @@
+import threading
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer.combiner import Combiner
+from allocation.service_layer.handlers import InvalidSku
+from .test_handlers import FakeNotifications
+from .test_messagebus import CountingUnitOfWork
+
+
+def bootstrap_combiner(window=0.01, max_batch=100):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=CountingUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        coalesce_commands=True,
+    )
+    bus.handle(commands.CreateBatch("lamp-batch", "HOT-LAMP", 100, None))
+    bus.uow.commits = 0
+    return Combiner(bus, window=window, max_batch=max_batch)
+
+
+def submit_together(combiner, cmds):
+    results = [None] * len(cmds)
+    ready = threading.Barrier(len(cmds))
+
+    def submit(i):
+        ready.wait()
+        try:
+            results[i] = combiner.submit(cmds[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(cmds))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_commands_for_a_sku_commit_once():
+    combiner = bootstrap_combiner(window=1, max_batch=10)
+    results = submit_together(combiner, [commands.Allocate(f"o{i}", "HOT-LAMP", 1) for i in range(10)])
+
+    assert results == ["lamp-batch"] * 10
+    assert combiner.bus.uow.commits == 1
+    [batch] = combiner.bus.uow.products.get("HOT-LAMP").batches
+    assert batch.available_quantity == 90
+
+
+def test_each_caller_gets_its_own_failure():
+    combiner = bootstrap_combiner(window=1, max_batch=2)
+    results = submit_together(combiner, [
+        commands.Allocate("o1", "HOT-LAMP", 1),
+        commands.Allocate("o2", "NONEXISTENT", 1),
+    ])
+
+    assert results[0] == "lamp-batch"
+    assert isinstance(results[1], InvalidSku)
+
+
+def test_a_lone_command_is_handled_after_the_window():
+    combiner = bootstrap_combiner(window=0.001)
+    assert combiner.submit(commands.Allocate("o1", "HOT-LAMP", 1)) == "lamp-batch"
+    with pytest.raises(InvalidSku):
+        combiner.submit(commands.Allocate("o2", "NONEXISTENT", 1))
+
+
+def test_batches_wait_for_other_users_of_the_bus():
+    combiner = bootstrap_combiner(window=0.001)
+    results = []
+    with combiner.lock:
+        thread = threading.Thread(target=lambda: results.append(combiner.submit(commands.Allocate("o1", "HOT-LAMP", 1))))
+        thread.start()
+        thread.join(timeout=0.1)
+        assert results == []
+    thread.join()
+    assert results == ["lamp-batch"]
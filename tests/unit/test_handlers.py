@@ -4,7 +4,7 @@ from datetime import date, timedelta
 from typing import Dict, List
 from allocation import bootstrap
 from allocation.adapters import notifications, repository
-from allocation.domain import commands
+from allocation.domain import commands, model
 from allocation.service_layer import handlers, unit_of_work
 
 
@@ -17,6 +17,7 @@ class FakeRepository(repository.AbstractProductRepository):
     def __init__(self, products):
         super().__init__()
         self._products = set(products)
+        self.archived = []  # type: List[model.Batch]
 
     def _add(self, product):
         self._products.add(product)
@@ -27,6 +28,9 @@ class FakeRepository(repository.AbstractProductRepository):
     def _get_by_batchref(self, batchref):
         return next((p for p in self._products for b in p.batches if b.reference == batchref), None)
 
+    def _archive(self, batches):
+        self.archived.extend(batches)
+
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
@@ -124,6 +128,78 @@ class TestAllocate:
         ]
 
 
+class TestAllocateMany:
+    def test_allocates_lines_in_order(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("in-stock-batch", "TALL-LAMP", 15, None))
+        bus.handle(commands.CreateBatch("shipment-batch", "TALL-LAMP", 100, tomorrow))
+        [batchrefs] = bus.handle(
+            commands.AllocateMany("TALL-LAMP", [("o1", 10), ("o2", 10), ("o3", 5)])
+        )
+        assert batchrefs == ["in-stock-batch", "shipment-batch", "in-stock-batch"]
+        assert bus.uow.products.get("TALL-LAMP").get_batch("in-stock-batch").available_quantity == 0
+
+    def test_bumps_the_version_once(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "SHORT-LAMP", 100, None))
+        product = bus.uow.products.get("SHORT-LAMP")
+        version = product.version_number
+        bus.handle(commands.AllocateMany("SHORT-LAMP", [("o1", 10), ("o2", 10)]))
+        assert product.version_number == version + 1
+
+    def test_sends_email_for_each_line_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "POPULAR-LAMP", 10, None))
+        [batchrefs] = bus.handle(
+            commands.AllocateMany("POPULAR-LAMP", [("o1", 20), ("o2", 5), ("o3", 20)])
+        )
+        assert batchrefs == [None, "b1", None]
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for POPULAR-LAMP"] * 2
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(commands.AllocateMany("NONEXISTENTSKU", [("o1", 10)]))
+
+
+class TestAllocateWave:
+    def test_allocates_lines_across_skus(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("lamp-batch", "WAVY-LAMP", 10, None))
+        bus.handle(commands.CreateBatch("rug-batch", "WAVY-RUG", 10, None))
+        [batchrefs] = bus.handle(
+            commands.AllocateWave(
+                [("o1", "WAVY-LAMP", 8), ("o1", "WAVY-RUG", 4), ("o2", "WAVY-LAMP", 5), ("o3", "WAVY-LAMP", 5)]
+            )
+        )
+        assert batchrefs == [None, "rug-batch", "lamp-batch", "lamp-batch"]
+        assert bus.uow.products.get("WAVY-LAMP").get_batch("lamp-batch").available_quantity == 0
+
+    def test_sends_email_for_each_line_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "WAVY-CURTAINS", 10, None))
+        bus.handle(commands.AllocateWave([("o1", "WAVY-CURTAINS", 20), ("o2", "WAVY-CURTAINS", 10)]))
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for WAVY-CURTAINS"]
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None))
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(commands.AllocateWave([("o1", "AREALSKU", 10), ("o1", "NONEXISTENTSKU", 10)]))
+
+
 class TestDeallocate:
     def decrements_available_quantity(self):
         bus = bootstrap_test_app()
@@ -154,6 +230,26 @@ class TestDeallocate:
             bus.handle(commands.Deallocate("o1", "POPULAR-CURTAINS", 10))
 
 
+class TestArchiveBatches:
+    def test_archives_exhausted_batches_that_have_arrived(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("full-batch", "DUSTY-LAMP", 10, None))
+        bus.handle(commands.CreateBatch("open-batch", "DUSTY-LAMP", 10, None))
+        bus.handle(commands.CreateBatch("full-future-batch", "DUSTY-LAMP", 10, later))
+        bus.handle(commands.Allocate("o1", "DUSTY-LAMP", 10))
+        bus.handle(commands.Allocate("o2", "DUSTY-LAMP", 5))
+        bus.handle(commands.Allocate("o3", "DUSTY-LAMP", 5))
+        bus.handle(commands.Allocate("o4", "DUSTY-LAMP", 10))
+
+        [archived] = bus.handle(commands.ArchiveBatches("DUSTY-LAMP", as_of=today))
+
+        assert archived == ["full-batch", "open-batch"]
+        assert [b.reference for b in bus.uow.products.archived] == archived
+        product = bus.uow.products.get("DUSTY-LAMP")
+        assert [b.reference for b in product.batches] == ["full-future-batch"]
+        assert not product.is_allocated(model.OrderLine("o1", "DUSTY-LAMP", 10))
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
@@ -178,4 +274,16 @@ class TestChangeBatchQuantity:
         assert batch2.available_quantity == 50
         bus.handle(commands.ChangeBatchQuantity("batch1", 25))
         assert batch1.available_quantity == 5
-        assert batch2.available_quantity == 30
\ No newline at end of file
+        assert batch2.available_quantity == 30
+
+    def test_reallocates_within_the_same_command(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "CHEERFUL-TABLE", 50, None))
+        bus.handle(commands.CreateBatch("batch2", "CHEERFUL-TABLE", 50, date.today()))
+        for orderid in ("order1", "order2", "order3"):
+            bus.handle(commands.Allocate(orderid, "CHEERFUL-TABLE", 10))
+        results = bus.handle(commands.ChangeBatchQuantity("batch1", 5))
+        assert results == [None]
+        [batch1, batch2] = bus.uow.products.get("CHEERFUL-TABLE").batches
+        assert batch1.available_quantity == 5
+        assert batch2.available_quantity == 20
\ No newline at end of file
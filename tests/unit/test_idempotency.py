@@ -0,0 +1,49 @@
+from allocation.adapters.idempotency import MemoryIdempotencyStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_returns_stored_results():
+    store = MemoryIdempotencyStore()
+    store.put("Allocate:key1", "batch1")
+    assert store.get("Allocate:key1") == (True, "batch1")
+    assert store.get("Allocate:key2") == (False, None)
+
+
+def test_stores_none_results():
+    store = MemoryIdempotencyStore()
+    store.put("ChangeBatchQuantity:key1", None)
+    assert store.get("ChangeBatchQuantity:key1") == (True, None)
+
+
+def test_results_expire_after_the_ttl():
+    clock = FakeClock()
+    store = MemoryIdempotencyStore(ttl=60, clock=clock)
+    store.put("key1", "batch1")
+    clock.now = 59
+    assert store.get("key1") == (True, "batch1")
+    clock.now = 60
+    assert store.get("key1") == (False, None)
+
+
+def test_expired_results_are_dropped_on_put():
+    clock = FakeClock()
+    store = MemoryIdempotencyStore(ttl=60, clock=clock)
+    store.put("key1", "batch1")
+    clock.now = 61
+    store.put("key2", "batch2")
+    assert list(store._results) == ["key2"]
+
+
+def test_oldest_results_are_dropped_past_maxsize():
+    store = MemoryIdempotencyStore(maxsize=2)
+    for i in range(3):
+        store.put(f"key{i}", f"batch{i}")
+    assert store.get("key0") == (False, None)
+    assert store.get("key2") == (True, "batch2")
@@ -0,0 +1,601 @@
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from allocation import bootstrap, tracing
+from allocation.adapters import repository
+from allocation.adapters.idempotency import MemoryIdempotencyStore
+from allocation.domain import commands, events, model
+from allocation.metrics import Metrics
+from allocation.service_layer import handlers, messagebus, unit_of_work
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+class CountingUnitOfWork(FakeUnitOfWork):
+    def __init__(self):
+        super().__init__()
+        self.commits = 0
+
+    def _commit(self):
+        super()._commit()
+        self.commits += 1
+
+
+def bootstrap_counting_app(notifications=None):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=CountingUnitOfWork(),
+        notifications=notifications or FakeNotifications(),
+        publish=lambda *args: None,
+    )
+
+
+def test_outbox_and_product_cache_can_be_set_up_for_any_unit_of_work():
+    uow = FakeUnitOfWork()
+    cache = repository.ProductCache()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        use_outbox=True,
+        product_cache=cache,
+        warm_product_cache=10,
+    )
+    assert uow.outbox_channels == handlers.PUBLISHED_CHANNELS
+    assert uow.product_cache is cache
+    bus.handle(commands.CreateBatch("b1", "OUTBOX-LAMP", 100, None))
+
+
+class TestHandleMany:
+    def test_commits_once_per_sku(self):
+        bus = bootstrap_counting_app()
+        bus.handle(commands.CreateBatch("lamp-batch", "BULK-LAMP", 100, None))
+        bus.handle(commands.CreateBatch("rug-batch", "BULK-RUG", 100, None))
+        bus.uow.commits = 0
+
+        results = bus.handle_many([
+            commands.Allocate("o1", "BULK-LAMP", 10),
+            commands.Allocate("o1", "BULK-RUG", 10),
+            commands.Allocate("o2", "BULK-LAMP", 10),
+            commands.Allocate("o3", "BULK-LAMP", 10),
+        ])
+
+        assert results == ["lamp-batch", "rug-batch", "lamp-batch", "lamp-batch"]
+        assert bus.uow.commits == 2
+        assert bus.uow.products.get("BULK-LAMP").get_batch("lamp-batch").available_quantity == 70
+
+    def test_handles_events_after_the_commit(self):
+        notifications = FakeNotifications()
+        bus = bootstrap_counting_app(notifications)
+        bus.handle(commands.CreateBatch("b1", "BULK-CURTAINS", 10, None))
+        bus.handle_many([
+            commands.Allocate("o1", "BULK-CURTAINS", 10),
+            commands.Allocate("o2", "BULK-CURTAINS", 10),
+        ])
+        assert notifications.sent["stock@made.com"] == ["Out of stock for BULK-CURTAINS"]
+
+    def test_only_the_failing_command_fails(self):
+        bus = bootstrap_counting_app()
+        bus.handle(commands.CreateBatch("b1", "BULK-MIRROR", 100, None))
+
+        results = bus.handle_many(
+            [
+                commands.Allocate("o1", "BULK-MIRROR", 10),
+                commands.Deallocate("o2", "BULK-MIRROR", 10),
+                commands.Allocate("o3", "BULK-MIRROR", 10),
+            ],
+            return_exceptions=True,
+        )
+
+        assert results[0] == results[2] == "b1"
+        assert isinstance(results[1], handlers.NotAllocated)
+        assert bus.uow.products.get("BULK-MIRROR").get_batch("b1").available_quantity == 80
+
+    def test_raises_failures_by_default(self):
+        bus = bootstrap_counting_app()
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle_many([commands.Allocate("o1", "NONEXISTENTSKU", 10)])
+
+    def test_batch_changes_keep_their_place_among_their_skus_commands(self):
+        bus = bootstrap_counting_app()
+        bus.handle(commands.CreateBatch("b1", "BULK-LAMP", 10, None))
+        bus.batchref_skus = repository.BatchrefSkus()  # found through the unit of work
+
+        results = bus.handle_many([
+            commands.Allocate("o1", "BULK-LAMP", 10),
+            commands.ChangeBatchQuantity("b1", 20),
+            commands.Allocate("o2", "BULK-LAMP", 10),
+        ])
+
+        assert results == ["b1", None, "b1"]
+
+    def test_commands_without_a_sku_are_handled_in_their_place(self):
+        bus = bootstrap_counting_app()
+        bus.handle(commands.CreateBatch("b1", "BULK-LAMP", 10, None))
+
+        results = bus.handle_many([
+            commands.Allocate("o1", "BULK-LAMP", 10),
+            commands.ChangeBatchQuantity("no-such-batch", 20),
+            commands.Allocate("o2", "BULK-LAMP", 10),
+        ], return_exceptions=True)
+
+        assert results[0] == "b1"
+        assert isinstance(results[1], Exception)
+        assert results[2] is None
+
+
+class TestSideEffects:
+    @staticmethod
+    def bootstrap_background_app(publish, timeout=10.0):
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=publish,
+            side_effect_executor=ThreadPoolExecutor(max_workers=2),
+            side_effect_timeout=timeout,
+        )
+
+    def test_returns_without_waiting_for_side_effects(self):
+        release = threading.Event()
+        published = []
+
+        def slow_publish(channel, event):
+            release.wait(5)
+            published.append(channel)
+
+        bus = self.bootstrap_background_app(slow_publish)
+        bus.handle(commands.CreateBatch("b1", "SLOW-LAMP", 100, None))
+        [batchref] = bus.handle(commands.Allocate("o1", "SLOW-LAMP", 10))
+
+        assert batchref == "b1"
+        assert published == []
+        release.set()
+        assert bus.wait_for_side_effects()
+        assert sorted(published) == ["batch_created", "line_allocated"]
+
+    def test_side_effect_failures_are_logged_not_raised(self, caplog):
+        def failing_publish(channel, event):
+            raise ConnectionError("redis is down")
+
+        bus = self.bootstrap_background_app(failing_publish)
+        bus.handle(commands.CreateBatch("b1", "FLAKY-LAMP", 100, None))
+        assert bus.wait_for_side_effects()
+        assert "redis is down" in caplog.text
+
+    def test_logs_side_effects_that_overrun(self, caplog):
+        release = threading.Event()
+        bus = self.bootstrap_background_app(lambda *args: release.wait(5), timeout=0.01)
+        bus.handle(commands.CreateBatch("b1", "STUCK-LAMP", 100, None))
+
+        assert not bus.wait_for_side_effects()
+        assert "Side effect still running" in caplog.text
+        release.set()
+        assert bus.wait_for_side_effects(timeout=5)
+        assert "over the 0.0s timeout" in caplog.text
+
+    def test_handlers_using_the_uow_are_not_side_effects(self):
+        bus = bootstrap_counting_app()
+        assert not bus.event_handlers[events.Allocated][1].side_effect_only
+        assert bus.event_handlers[events.Allocated][0].side_effect_only
+
+
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+        self.attempts = 0
+
+    def _commit(self):
+        self.attempts += 1
+        if self.conflicts:
+            self.conflicts -= 1
+            raise unit_of_work.ConcurrencyError("version_number changed")
+        super()._commit()
+
+
+class TestRetries:
+    @staticmethod
+    def bootstrap_conflicting_app(conflicts, max_retries=3):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=ConflictingUnitOfWork(0),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            max_retries=max_retries,
+        )
+        bus.retry_backoff = 0
+        bus.handle(commands.CreateBatch("b1", "RACY-LAMP", 100, None))
+        bus.uow.conflicts = conflicts
+        bus.uow.attempts = 0
+        return bus
+
+    def test_retries_commands_that_conflict(self):
+        bus = self.bootstrap_conflicting_app(conflicts=2)
+        assert bus.handle(commands.Allocate("o1", "RACY-LAMP", 10)) == ["b1"]
+        assert bus.uow.attempts == 3
+        assert bus.uow.committed
+
+    def test_gives_up_after_max_retries(self):
+        bus = self.bootstrap_conflicting_app(conflicts=5, max_retries=2)
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            bus.handle(commands.Allocate("o1", "RACY-LAMP", 10))
+        assert bus.uow.attempts == 3
+
+    def test_other_errors_are_not_retried(self):
+        bus = self.bootstrap_conflicting_app(conflicts=5)
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+        assert bus.uow.attempts == 0
+
+
+class TestMetrics:
+    def test_records_handlers_commits_and_errors(self):
+        metrics = Metrics()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            metrics=metrics,
+        )
+        bus.handle(commands.CreateBatch("b1", "COUNTED-LAMP", 10, None))
+        bus.handle(commands.Allocate("o1", "COUNTED-LAMP", 10))
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o2", "NONEXISTENTSKU", 10))
+
+        text = metrics.render()
+        assert 'allocation_command_seconds_count{command="Allocate"} 1' in text
+        assert 'allocation_command_errors_total{command="Allocate"} 1' in text
+        assert 'allocation_events_per_command_sum{command="Allocate"} 1' in text
+        assert (
+            'allocation_event_handler_seconds_count'
+            '{event="Allocated",handler="publish_allocated_event"} 1'
+        ) in text
+        # the fake unit of work has no session for the read model
+        assert (
+            'allocation_event_handler_errors_total'
+            '{event="Allocated",handler="add_allocation_to_read_model"} 1'
+        ) in text
+        assert "allocation_uow_commit_seconds_count 2" in text
+        assert "allocation_queue_depth_count" in text
+
+    def test_records_commands_handled_together(self):
+        metrics = Metrics()
+        bus = bootstrap_counting_app()
+        bus.handle(commands.CreateBatch("b1", "GROUPED-LAMP", 100, None))
+        bus.metrics = metrics
+
+        bus.handle_many(
+            [
+                commands.Allocate("o1", "GROUPED-LAMP", 10),
+                commands.Allocate("o2", "GROUPED-LAMP", 10),
+                commands.Allocate("o3", "GROUPED-LAMP", 10),
+                commands.Deallocate("o4", "GROUPED-LAMP", 10),
+            ],
+            return_exceptions=True,
+        )
+        bus.handle_many([
+            commands.Allocate("o5", "GROUPED-LAMP", 10),
+            commands.Allocate("o6", "GROUPED-LAMP", 10),
+        ])
+
+        text = metrics.render()
+        assert 'allocation_command_errors_total{command="Deallocate",grouped="true"} 1' in text
+        # the first group was handled again one by one, the second together
+        assert 'allocation_command_seconds_count{command="Allocate"} 5' in text
+        assert 'allocation_events_per_command_sum{command="Allocate"} 5' in text
+        assert 'allocation_command_errors_total{command="Deallocate"} 1' in text
+
+    def test_counts_retries(self):
+        metrics = Metrics()
+        bus = TestRetries.bootstrap_conflicting_app(conflicts=2)
+        bus.metrics = metrics
+        bus.handle(commands.Allocate("o1", "RACY-LAMP", 10))
+        assert 'allocation_command_retries_total{command="Allocate"} 2' in metrics.render()
+
+
+class TestTracing:
+    @pytest.fixture(autouse=True)
+    def exporter(self):
+        exporter = tracing.MemoryExporter()
+        previous = tracing.configure(exporter)
+        yield exporter
+        tracing.configure(previous)
+
+    def test_events_carry_the_command_correlation_id(self):
+        published = []
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda channel, event: published.append(event),
+        )
+        command = commands.CreateBatch("b1", "TRACED-LAMP", 100, None)
+        command.correlation_id = "abc123"
+        bus.handle(command)
+        bus.handle(commands.Allocate("o1", "TRACED-LAMP", 10))
+
+        created, allocated = published
+        assert created.correlation_id == "abc123"
+        assert allocated.correlation_id not in (None, "abc123")
+
+    def test_records_spans_for_commands_handlers_and_the_uow(self, exporter):
+        bus = bootstrap_counting_app()
+        with tracing.correlation("abc123"):
+            bus.handle(commands.CreateBatch("b1", "TRACED-RUG", 100, None))
+
+        spans = {span.name: span for span in exporter.spans}
+        assert {"command", "repository.get", "repository.add", "uow.commit", "event_handler"} <= set(spans)
+        assert spans["repository.get"].parent_id == spans["command"].span_id
+        assert spans["event_handler"].attributes["handler"] == "publish_batch_created_event"
+        assert all(span.correlation_id == "abc123" for span in exporter.spans)
+
+    def test_side_effects_keep_the_correlation_id(self, exporter):
+        bus = TestSideEffects.bootstrap_background_app(lambda *args: None)
+        with tracing.correlation("abc123"):
+            bus.handle(commands.CreateBatch("b1", "TRACED-SOFA", 100, None))
+        assert bus.wait_for_side_effects()
+
+        [side_effect] = [span for span in exporter.spans if span.name == "side_effect"]
+        assert side_effect.correlation_id == "abc123"
+
+    def test_grouped_commands_keep_their_own_correlation_ids(self):
+        published = []
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda channel, event: published.append(event),
+        )
+        bus.handle(commands.CreateBatch("b1", "TRACED-CHAIR", 100, None))
+        first, second = commands.Allocate("o1", "TRACED-CHAIR", 10), commands.Allocate("o2", "TRACED-CHAIR", 10)
+        first.correlation_id, second.correlation_id = "first", "second"
+        bus.handle_many([first, second])
+
+        assert {event.orderid: event.correlation_id for event in published[1:]} == {"o1": "first", "o2": "second"}
+
+
+class TestIdempotency:
+    @staticmethod
+    def bootstrap_idempotent_app():
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=CountingUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            idempotency_store=MemoryIdempotencyStore(),
+        )
+        bus.handle(commands.CreateBatch("b1", "ONCE-LAMP", 100, None))
+        bus.handle(commands.CreateBatch("b2", "ONCE-RUG", 100, None))
+        bus.uow.commits = 0
+        return bus
+
+    @staticmethod
+    def keyed(command, key):
+        command.idempotency_key = key
+        return command
+
+    def test_replays_the_result_without_handling_again(self):
+        bus = self.bootstrap_idempotent_app()
+        assert bus.handle(self.keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1")) == ["b1"]
+        assert bus.handle(self.keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1")) == ["b1"]
+        assert bus.uow.commits == 1
+
+    def test_commands_without_keys_are_always_handled(self):
+        bus = self.bootstrap_idempotent_app()
+        bus.handle(commands.Allocate("o1", "ONCE-LAMP", 10))
+        bus.handle(commands.Allocate("o1", "ONCE-LAMP", 10))
+        assert bus.uow.commits == 2
+
+    def test_failures_are_not_remembered(self):
+        bus = self.bootstrap_idempotent_app()
+        with pytest.raises(handlers.NotAllocated):
+            bus.handle(self.keyed(commands.Deallocate("o1", "ONCE-LAMP", 10), "key1"))
+        bus.handle(commands.Allocate("o1", "ONCE-LAMP", 10))
+        bus.handle(self.keyed(commands.Deallocate("o1", "ONCE-LAMP", 10), "key1"))
+        assert not bus.uow.products.get("ONCE-LAMP").is_allocated(model.OrderLine("o1", "ONCE-LAMP", 10))
+
+    def test_replays_within_handle_many(self):
+        bus = self.bootstrap_idempotent_app()
+        bus.handle(self.keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1"))
+        bus.uow.commits = 0
+
+        results = bus.handle_many([
+            self.keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1"),
+            self.keyed(commands.Allocate("o2", "ONCE-RUG", 10), "key2"),
+            self.keyed(commands.Allocate("o3", "ONCE-RUG", 10), "key3"),
+        ])
+
+        assert results == ["b1", "b2", "b2"]
+        assert bus.uow.commits == 1
+        assert bus.handle(self.keyed(commands.Allocate("o3", "ONCE-RUG", 10), "key3")) == ["b2"]
+        assert bus.uow.commits == 1
+
+    def test_repeated_keys_within_handle_many_are_handled_once(self):
+        bus = self.bootstrap_idempotent_app()
+        bus.handle(commands.Allocate("o1", "ONCE-LAMP", 10))
+
+        results = bus.handle_many([
+            self.keyed(commands.Deallocate("o1", "ONCE-LAMP", 10), "key1"),
+            self.keyed(commands.Allocate("o2", "ONCE-LAMP", 10), "key2"),
+            self.keyed(commands.Deallocate("o1", "ONCE-LAMP", 10), "key1"),
+        ])
+
+        assert results == [None, "b1", None]
+        assert bus.uow.products.get("ONCE-LAMP").get_batch("b1").available_quantity == 90
+
+    def test_keys_are_per_command_type(self):
+        bus = self.bootstrap_idempotent_app()
+        bus.handle(self.keyed(commands.Allocate("o1", "ONCE-LAMP", 10), "key1"))
+        bus.handle(self.keyed(commands.Deallocate("o1", "ONCE-LAMP", 10), "key1"))
+        assert bus.uow.commits == 2
+
+
+class TestCoalesce:
+    def test_keeps_the_last_change_for_each_batch(self):
+        coalesced = messagebus.coalesce([
+            commands.ChangeBatchQuantity("b1", 50),
+            commands.ChangeBatchQuantity("b2", 40),
+            commands.ChangeBatchQuantity("b1", 30),
+        ])
+        assert coalesced == [
+            (commands.ChangeBatchQuantity("b2", 40), [1]),
+            (commands.ChangeBatchQuantity("b1", 30), [0, 2]),
+        ]
+
+    def test_kept_changes_stay_in_the_place_of_the_last_one(self):
+        messages = [
+            commands.ChangeBatchQuantity("b1", 50),
+            commands.ChangeBatchQuantity("b2", 40),
+            commands.ChangeBatchQuantity("b3", 20),
+            commands.ChangeBatchQuantity("b1", 30),
+            commands.ChangeBatchQuantity("b2", 10),
+        ]
+        assert [indexes for _, indexes in messagebus.coalesce(messages)] == [[2], [0, 3], [1, 4]]
+
+    def test_merges_allocations_for_a_sku(self):
+        coalesced = messagebus.coalesce([
+            commands.Allocate("o1", "MERGED-LAMP", 10),
+            commands.Allocate("o2", "MERGED-RUG", 10),
+            commands.Allocate("o3", "MERGED-LAMP", 5),
+        ])
+        assert coalesced == [
+            (commands.AllocateMany("MERGED-LAMP", [("o1", 10), ("o3", 5)]), [0, 2]),
+            (commands.Allocate("o2", "MERGED-RUG", 10), [1]),
+        ]
+
+    def test_other_commands_for_the_sku_are_barriers(self):
+        messages = [
+            commands.Allocate("o1", "MERGED-LAMP", 10),
+            commands.Deallocate("o1", "MERGED-LAMP", 10),
+            commands.Allocate("o1", "MERGED-LAMP", 10),
+        ]
+        assert [indexes for _, indexes in messagebus.coalesce(messages)] == [[0], [1], [2]]
+
+    def test_batch_changes_and_allocations_do_not_cross(self):
+        messages = [
+            commands.ChangeBatchQuantity("b1", 50),
+            commands.Allocate("o1", "MERGED-LAMP", 10),
+            commands.ChangeBatchQuantity("b1", 30),
+            commands.Allocate("o2", "MERGED-LAMP", 10),
+        ]
+        assert [indexes for _, indexes in messagebus.coalesce(messages)] == [[0], [1], [2], [3]]
+
+    def test_leaves_commands_with_idempotency_keys_alone(self):
+        keyed = commands.ChangeBatchQuantity("b1", 30)
+        keyed.idempotency_key = "key1"
+        messages = [commands.ChangeBatchQuantity("b1", 50), keyed]
+        assert [indexes for _, indexes in messagebus.coalesce(messages)] == [[0], [1]]
+
+
+class TestHandleManyCoalesced:
+    @staticmethod
+    def bootstrap_coalescing_app(metrics=None):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=CountingUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            metrics=metrics,
+            coalesce_commands=True,
+        )
+        bus.handle(commands.CreateBatch("b1", "FEED-LAMP", 100, None))
+        bus.handle(commands.CreateBatch("b2", "FEED-RUG", 100, None))
+        return bus
+
+    def test_results_map_back_to_each_message(self):
+        metrics = Metrics()
+        bus = self.bootstrap_coalescing_app(metrics)
+        results = bus.handle_many(
+            [
+                commands.ChangeBatchQuantity("b1", 80),
+                commands.ChangeBatchQuantity("b1", 60),
+                commands.Allocate("o1", "FEED-LAMP", 10),
+                commands.Allocate("o2", "FEED-RUG", 10),
+                commands.Allocate("o3", "FEED-LAMP", 10),
+                commands.Allocate("o4", "NONEXISTENTSKU", 10),
+                commands.Allocate("o5", "NONEXISTENTSKU", 10),
+            ],
+            return_exceptions=True,
+        )
+
+        assert results[:5] == [None, None, "b1", "b2", "b1"]
+        assert all(isinstance(result, handlers.InvalidSku) for result in results[5:])
+        lamp = bus.uow.products.get("FEED-LAMP")
+        assert lamp.get_batch("b1").available_quantity == 40
+        assert 'allocation_messages_coalesced_total{command="ChangeBatchQuantity"} 1' in metrics.render()
+        assert 'allocation_messages_coalesced_total{command="Allocate"} 2' in metrics.render()
+
+    def test_merged_allocations_bump_the_version_once(self):
+        bus = self.bootstrap_coalescing_app()
+        version = bus.uow.products.get("FEED-LAMP").version_number
+        bus.handle_many([commands.Allocate(f"o{i}", "FEED-LAMP", 1) for i in range(10)])
+        assert bus.uow.products.get("FEED-LAMP").version_number == version + 1
+
+    def test_raises_failures_by_default(self):
+        bus = self.bootstrap_coalescing_app()
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle_many([commands.Allocate("o1", "NONEXISTENTSKU", 10)])
+
+
+class TestPriorities:
+    @staticmethod
+    def bootstrap_scheduling_app(handled):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=CountingUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            priorities=handlers.PRIORITIES,
+        )
+        for sku in ("HOT-LAMP", "COLD-RUG", "COLD-CHAIR"):
+            bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 1000, None))
+        bus.uow.commits = 0
+        bus.max_run = 2
+        for command_type, handler in list(bus.command_handlers.items()):
+            def recording(command, handler=handler):
+                handled.append(command)
+                return handler(command)
+            bus.command_handlers[command_type] = recording
+        return bus
+
+    def test_skus_take_turns_in_handle_many(self):
+        handled = []
+        bus = self.bootstrap_scheduling_app(handled)
+        results = bus.handle_many([
+            commands.Allocate("o1", "HOT-LAMP", 1),
+            commands.Allocate("o2", "HOT-LAMP", 1),
+            commands.Allocate("o3", "HOT-LAMP", 1),
+            commands.Allocate("o4", "HOT-LAMP", 1),
+            commands.Allocate("o5", "COLD-RUG", 1),
+        ])
+
+        assert results == ["HOT-LAMP-batch"] * 4 + ["COLD-RUG-batch"]
+        assert [c.orderid for c in handled] == ["o1", "o2", "o5", "o3", "o4"]
+        assert bus.uow.commits == 3
+
+    def test_urgent_commands_go_first_without_reordering_a_sku(self):
+        handled = []
+        bus = self.bootstrap_scheduling_app(handled)
+        bus.handle_many([
+            commands.Allocate("o1", "COLD-RUG", 1),
+            commands.Deallocate("o1", "COLD-RUG", 1),
+            commands.Deallocate("o9", "COLD-CHAIR", 1),
+        ], return_exceptions=True)
+
+        assert [type(c).__name__ + ":" + c.sku for c in handled] == [
+            "Deallocate:COLD-CHAIR", "Allocate:COLD-RUG", "Deallocate:COLD-RUG",
+        ]
+
+    def test_batch_changes_wait_for_earlier_commands_for_their_sku(self):
+        handled = []
+        bus = self.bootstrap_scheduling_app(handled)
+        bus.handle_many([
+            commands.Allocate("o1", "COLD-RUG", 1),
+            commands.ChangeBatchQuantity("COLD-RUG-batch", 10),
+            commands.ChangeBatchQuantity("COLD-CHAIR-batch", 10),
+        ])
+
+        assert [type(c).__name__ for c in handled] == ["ChangeBatchQuantity", "Allocate", "ChangeBatchQuantity"]
+        assert handled[0].ref == "COLD-CHAIR-batch"
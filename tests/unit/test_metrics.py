@@ -0,0 +1,41 @@
+from allocation.metrics import Metrics
+
+
+def test_histograms_render_cumulative_buckets():
+    metrics = Metrics()
+    metrics.observe("command_seconds", 0.0004, command="Allocate")
+    metrics.observe("command_seconds", 0.02, command="Allocate")
+    metrics.observe("command_seconds", 60, command="Allocate")
+
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE allocation_command_seconds histogram" in lines
+    assert 'allocation_command_seconds_bucket{command="Allocate",le="0.0005"} 1' in lines
+    assert 'allocation_command_seconds_bucket{command="Allocate",le="0.01"} 1' in lines
+    assert 'allocation_command_seconds_bucket{command="Allocate",le="0.025"} 2' in lines
+    assert 'allocation_command_seconds_bucket{command="Allocate",le="+Inf"} 3' in lines
+    assert 'allocation_command_seconds_count{command="Allocate"} 3' in lines
+
+
+def test_counts_use_count_buckets():
+    metrics = Metrics()
+    metrics.observe("queue_depth", 3)
+    assert 'allocation_queue_depth_bucket{le="2"} 0' in metrics.render()
+    assert 'allocation_queue_depth_bucket{le="5"} 1' in metrics.render()
+
+
+def test_counters_are_kept_per_label():
+    metrics = Metrics()
+    metrics.increment("command_errors_total", command="Allocate")
+    metrics.increment("command_errors_total", command="Allocate")
+    metrics.increment("command_errors_total", command="Deallocate")
+
+    lines = metrics.render().splitlines()
+    assert 'allocation_command_errors_total{command="Allocate"} 2' in lines
+    assert 'allocation_command_errors_total{command="Deallocate"} 1' in lines
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.increment("errors_total", message='say "hi"\n')
+    assert 'allocation_errors_total{message="say \\"hi\\"\\n"} 1' in metrics.render()
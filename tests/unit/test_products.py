@@ -59,4 +59,113 @@ def test_increments_version_number():
     )
     product.version_number = 7
     product.allocate(line)
-    assert product.version_number == 8
\ No newline at end of file
+    assert product.version_number == 8
+
+def test_batches_added_later_are_allocated_in_eta_order():
+    product = Product(sku="LATE-LAMP", batches=[])
+    product.add_batch(Batch("slow-batch", "LATE-LAMP", 100, eta=later))
+    product.add_batch(Batch("speedy-batch", "LATE-LAMP", 100, eta=today))
+    product.add_batch(Batch("in-stock-batch", "LATE-LAMP", 100, eta=None))
+
+    assert product.allocate(OrderLine("order1", "LATE-LAMP", 10)) == "in-stock-batch"
+
+
+def test_skips_exhausted_batches_until_stock_is_freed():
+    in_stock_batch = Batch("in-stock-batch", "TINY-VASE", 10, eta=None)
+    shipment_batch = Batch("shipment-batch", "TINY-VASE", 100, eta=tomorrow)
+    product = Product(sku="TINY-VASE", batches=[in_stock_batch, shipment_batch])
+    first_line = OrderLine("order1", "TINY-VASE", 10)
+
+    assert product.allocate(first_line) == "in-stock-batch"
+    assert list(product._open_batches()) == [shipment_batch]
+    assert product.allocate(OrderLine("order2", "TINY-VASE", 1)) == "shipment-batch"
+
+    product.deallocate(first_line)
+    assert product.allocate(OrderLine("order3", "TINY-VASE", 1)) == "in-stock-batch"
+
+
+def test_deallocates_from_the_batch_holding_the_line():
+    in_stock_batch = Batch("in-stock-batch", "FLUFFY-RUG", 10, eta=None)
+    shipment_batch = Batch("shipment-batch", "FLUFFY-RUG", 100, eta=tomorrow)
+    product = Product(sku="FLUFFY-RUG", batches=[in_stock_batch, shipment_batch])
+    product.allocate(OrderLine("order1", "FLUFFY-RUG", 10))
+    line = OrderLine("order2", "FLUFFY-RUG", 10)
+    product.allocate(line)
+
+    assert product.is_allocated(line)
+    assert product.deallocate(line) == "shipment-batch"
+    assert not product.is_allocated(line)
+    assert shipment_batch.available_quantity == 100
+
+
+def test_allocating_an_allocated_line_again_changes_nothing():
+    batch = Batch("batch1", "SNUG-SOFA", 100, eta=None)
+    product = Product(sku="SNUG-SOFA", batches=[batch])
+    line = OrderLine("order1", "SNUG-SOFA", 10)
+    product.allocate(line)
+
+    assert product.allocate(line) == "batch1"
+    assert batch.available_quantity == 90
+    assert len(product.events) == 1
+
+
+def test_records_not_allocated_event_if_line_is_not_allocated():
+    product = Product(sku="SHY-LAMP", batches=[Batch("batch1", "SHY-LAMP", 100, eta=None)])
+    assert product.deallocate(OrderLine("order1", "SHY-LAMP", 10)) is None
+    assert product.events[-1] == events.NotAllocated(orderid="order1")
+
+
+def test_allocate_many_records_an_event_per_line_in_order():
+    product = Product(sku="BULK-BIN", batches=[Batch("batch1", "BULK-BIN", 10, eta=None)])
+    product.allocate_many([OrderLine("order1", "BULK-BIN", 8), OrderLine("order2", "BULK-BIN", 8)])
+    assert product.events == [
+        events.Allocated(orderid="order1", sku="BULK-BIN", qty=8, batchref="batch1"),
+        events.OutOfStock(sku="BULK-BIN"),
+    ]
+    assert product.version_number == 1
+
+
+def test_reallocates_lines_displaced_by_a_smaller_batch_in_place():
+    in_stock_batch = Batch("in-stock-batch", "HEAVY-DESK", 20, eta=None)
+    shipment_batch = Batch("shipment-batch", "HEAVY-DESK", 10, eta=tomorrow)
+    product = Product(sku="HEAVY-DESK", batches=[in_stock_batch, shipment_batch])
+    product.allocate(OrderLine("order1", "HEAVY-DESK", 10))
+    product.allocate(OrderLine("order2", "HEAVY-DESK", 10))
+    product.events.clear()
+    version = product.version_number
+
+    product.change_batch_quantity("in-stock-batch", 0)
+
+    [allocated] = [e for e in product.events if isinstance(e, events.Allocated)]
+    assert allocated.batchref == "shipment-batch"
+    assert events.OutOfStock(sku="HEAVY-DESK") in product.events
+    assert len(product.events) == 2
+    assert shipment_batch.available_quantity == 0
+    assert product.version_number == version + 1
+
+
+def test_allocate_wave_records_an_event_per_line_in_arrival_order():
+    product = Product(sku="WAVY-BIN", batches=[Batch("batch1", "WAVY-BIN", 10, eta=None)])
+    lines = [OrderLine("order1", "WAVY-BIN", 8), OrderLine("order2", "WAVY-BIN", 5), OrderLine("order3", "WAVY-BIN", 5)]
+    assert product.allocate_wave(lines) == [None, "batch1", "batch1"]
+    assert product.events == [
+        events.OutOfStock(sku="WAVY-BIN"),
+        events.Allocated(orderid="order2", sku="WAVY-BIN", qty=5, batchref="batch1"),
+        events.Allocated(orderid="order3", sku="WAVY-BIN", qty=5, batchref="batch1"),
+    ]
+    assert product.version_number == 1
+
+
+def test_allocate_wave_allocates_as_usual_when_the_plan_is_out_of_date():
+    early = Batch("early", "WAVY-SHELF", 10, eta=None)
+    late = Batch("late", "WAVY-SHELF", 10, eta=tomorrow)
+    product = Product(sku="WAVY-SHELF", batches=[early, late])
+    lines = [OrderLine("order1", "WAVY-SHELF", 8), OrderLine("order2", "WAVY-SHELF", 5)]
+    product.allocate(OrderLine("order0", "WAVY-SHELF", 6))
+
+    assert product.allocate_wave(lines, plan=["early", "early"]) == ["late", None]
+    assert early.allocated_quantity == 6
+    assert product.events[-2:] == [
+        events.Allocated(orderid="order1", sku="WAVY-SHELF", qty=8, batchref="late"),
+        events.OutOfStock(sku="WAVY-SHELF"),
+    ]
@@ -0,0 +1,41 @@
+from allocation.domain import commands, model
+from allocation.entrypoints import redis_eventconsumer
+from .test_handlers import FakeUnitOfWork
+
+
+def worker_for_each(partitioner, cmds):
+    return [partitioner.worker_for(cmd) for cmd in cmds]
+
+
+class TestPartitioner:
+    def test_commands_for_one_sku_go_to_one_worker(self):
+        partitioner = redis_eventconsumer.Partitioner(4, FakeUnitOfWork())
+        workers = worker_for_each(partitioner, [
+            commands.CreateBatch("b1", "RED-CHAIR", 100, None),
+            commands.Allocate("o1", "RED-CHAIR", 10),
+            commands.Deallocate("o1", "RED-CHAIR", 10),
+        ])
+        assert len(set(workers)) == 1
+
+    def test_skus_are_spread_across_workers(self):
+        partitioner = redis_eventconsumer.Partitioner(4, FakeUnitOfWork())
+        workers = {partitioner.worker_for(commands.Allocate("o1", f"SKU-{i}", 1)) for i in range(100)}
+        assert workers == {0, 1, 2, 3}
+
+    def test_batch_changes_follow_their_sku(self):
+        uow = FakeUnitOfWork()
+        uow.products.add(model.Product("BLUE-SOFA", [model.Batch("b1", "BLUE-SOFA", 100, None)]))
+        partitioner = redis_eventconsumer.Partitioner(4, uow)
+        assert partitioner.worker_for(commands.ChangeBatchQuantity("b1", 50)) == \
+            partitioner.worker_for(commands.Allocate("o1", "BLUE-SOFA", 10))
+
+    def test_batches_created_in_the_same_batch_of_messages(self):
+        partitioner = redis_eventconsumer.Partitioner(4, FakeUnitOfWork())
+        partitions = partitioner.partition([
+            commands.CreateBatch("b2", "GREEN-LAMP", 100, None),
+            commands.ChangeBatchQuantity("b2", 50),
+        ])
+        assert list(partitions.values()) == [[
+            commands.CreateBatch("b2", "GREEN-LAMP", 100, None),
+            commands.ChangeBatchQuantity("b2", 50),
+        ]]
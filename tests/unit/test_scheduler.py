@@ -0,0 +1,53 @@
+import pytest
+from allocation.service_layer.scheduler import Scheduler
+
+
+def scheduler(items=()):
+    # items are (lane, priority, name)
+    return Scheduler(lambda item: item[1], lambda item: item[0], levels=3, items=items)
+
+
+def names(scheduler):
+    popped = []
+    while scheduler:
+        popped.append(scheduler.popleft()[2])
+    return popped
+
+
+def test_lanes_take_turns():
+    assert names(scheduler([
+        ("hot", 1, "h1"), ("hot", 1, "h2"), ("hot", 1, "h3"), ("cold", 1, "c1"), ("warm", 1, "w1"),
+    ])) == ["h1", "c1", "w1", "h2", "h3"]
+
+
+def test_urgent_heads_go_first():
+    assert names(scheduler([
+        ("a", 2, "a1"), ("b", 1, "b1"), ("c", 0, "c1"),
+    ])) == ["c1", "b1", "a1"]
+
+
+def test_a_lane_keeps_its_order_whatever_the_priorities():
+    assert names(scheduler([
+        ("a", 2, "a1"), ("a", 0, "a2"), ("b", 1, "b1"),
+    ])) == ["b1", "a1", "a2"]
+
+
+def test_pop_run_takes_from_one_lane():
+    s = scheduler([("a", 1, "a1"), ("a", 1, "a2"), ("a", 1, "a3"), ("b", 1, "b1")])
+    assert [name for _, _, name in s.pop_run(2)] == ["a1", "a2"]
+    assert len(s) == 2
+    assert [name for _, _, name in s.pop_run(2)] == ["b1"]
+    assert [name for _, _, name in s.pop_run(2)] == ["a3"]
+    assert not s
+
+
+def test_items_can_be_added_while_popping():
+    s = scheduler([("a", 1, "a1")])
+    assert s.popleft()[2] == "a1"
+    s.extend([("a", 1, "a2"), ("b", 0, "b1")])
+    assert names(s) == ["b1", "a2"]
+
+
+def test_popping_when_empty_raises():
+    with pytest.raises(IndexError):
+        scheduler().popleft()
@@ -0,0 +1,64 @@
+# pylint: disable=redefined-outer-name
+import json
+import pytest
+from allocation import tracing
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.MemoryExporter()
+    previous = tracing.configure(exporter)
+    yield exporter
+    tracing.configure(previous)
+
+
+def test_spans_are_not_recorded_without_an_exporter():
+    with tracing.span("anything") as span:
+        assert span is None
+
+
+def test_spans_nest_and_carry_the_correlation_id(exporter):
+    with tracing.correlation("abc123"):
+        with tracing.span("outer") as outer:
+            with tracing.span("inner", sku="RED-CHAIR"):
+                pass
+
+    inner, recorded_outer = exporter.spans
+    assert recorded_outer is outer
+    assert inner.parent_id == outer.span_id
+    assert outer.parent_id is None
+    assert inner.correlation_id == outer.correlation_id == "abc123"
+    assert inner.as_dict()["sku"] == "RED-CHAIR"
+    assert outer.duration >= inner.duration
+
+
+def test_spans_record_errors(exporter):
+    with pytest.raises(ValueError):
+        with tracing.span("failing"):
+            raise ValueError("boom")
+    [span] = exporter.spans
+    assert span.error == "ValueError('boom')"
+
+
+def test_correlation_is_restored_afterwards():
+    with tracing.correlation("outer"):
+        with tracing.correlation("inner"):
+            assert tracing.get_correlation_id() == "inner"
+        assert tracing.get_correlation_id() == "outer"
+    assert tracing.get_correlation_id() is None
+
+
+def test_exports_one_json_line_per_span(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    previous = tracing.configure(tracing.JsonLinesExporter(str(path)))
+    try:
+        with tracing.correlation("abc123"), tracing.span("repository.get", sku="RED-CHAIR"):
+            pass
+    finally:
+        tracing.configure(previous)
+
+    [line] = path.read_text().splitlines()
+    span = json.loads(line)
+    assert span["name"] == "repository.get"
+    assert span["correlation_id"] == "abc123"
+    assert span["sku"] == "RED-CHAIR"
@@ -0,0 +1,36 @@
+from concurrent.futures import ProcessPoolExecutor
+from allocation.domain import wave
+
+
+def test_serves_more_lines_than_allocating_in_arrival_order():
+    problem = wave.Problem(batches=[("batch1", 10)], qtys=[8, 5, 5])
+    assert wave.solve(problem) == [None, "batch1", "batch1"]
+
+
+def test_prefers_earlier_batches():
+    problem = wave.Problem(batches=[("early", 10), ("late", 10)], qtys=[4, 6])
+    assert wave.solve(problem) == ["early", "early"]
+
+
+def test_packs_large_lines_first_to_avoid_fragmenting_batches():
+    problem = wave.Problem(batches=[("early", 6), ("late", 4)], qtys=[2, 2, 6])
+    assert wave.solve(problem) == ["late", "late", "early"]
+
+
+def test_leaves_lines_out_when_stock_is_too_fragmented():
+    problem = wave.Problem(batches=[("batch1", 5), ("batch2", 5)], qtys=[3, 3, 3, 3])
+    assert wave.solve(problem) == ["batch1", "batch2", None, None]
+
+
+def test_solves_problems_in_other_processes():
+    problems = [
+        wave.Problem(batches=[("batch1", 10)], qtys=[8, 5, 5]),
+        wave.Problem(batches=[("batch2", 10)], qtys=[20]),
+    ]
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert wave.solve_all(problems, executor) == [[None, "batch1", "batch1"], [None]]
+
+
+def test_never_leaves_out_more_lines_than_arrival_order():
+    problem = wave.Problem(batches=[("b0", 20), ("b1", 12)], qtys=[9, 12, 11])
+    assert wave.solve(problem) == ["b0", "b1", "b0"]